@@ -0,0 +1,133 @@
+import io
+import os
+import asyncio
+import logging
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import Pipeline
+import Processors
+
+BATCH_BARS = 64  # bars per executor call, a call per bar would cost more than it overlaps
+QUEUE_BATCHES = 4  # count of batches generated ahead of the MIDI encoder
+
+
+async def _call(executor, function, *args):
+    # a stage call in the executor; a cancelled call which already runs is finished
+    # by its thread and its result is dropped
+    return await asyncio.wrap_future(executor.submit(function, *args))
+
+
+def _next_batch(bars) -> list:
+    return list(itertools.islice(bars, BATCH_BARS))
+
+
+async def _produce_bars(executor, bars, queue: asyncio.Queue):
+    # generates batches of bars in the executor while the consumer encodes the previous ones, an empty
+    # batch ends the melody; a failure is passed through the queue, so the consumer never waits for it
+    while True:
+        job = executor.submit(_next_batch, bars)
+        try:
+            batch = await asyncio.wrap_future(job)
+        except asyncio.CancelledError:
+            # the generator can be closed only when no thread runs it
+            job.add_done_callback(lambda _: bars.close())
+            raise
+        except Exception as error:
+            await queue.put(error)
+            return
+        await queue.put(batch)
+        if not batch:
+            return
+
+
+async def _write_midi(executor, midi_processor: Processors.MidiGeneratorProcessor, bars, stream,
+                      keep_bars: bool) -> list:
+    # bars N + 1.. are generated while bar N is encoded and flushed; returns generated bars when `keep_bars`
+    logging.info("Generating MIDI...")
+    queue = asyncio.Queue(QUEUE_BATCHES)
+    producer = asyncio.ensure_future(_produce_bars(executor, bars, queue))
+    generated = []
+    encoded_bars = collections.deque()
+    # bar_notes keeps the beat position between batches, it takes bars appended to `encoded_bars`
+    bar_notes = midi_processor.bar_notes(midi_processor.rich_mode, iter(encoded_bars.popleft, None))
+    midi = midi_processor.native_writer(stream)
+
+    def encode_batch(batch: list):
+        for bar in batch:
+            encoded_bars.append(bar)
+            midi_processor.write_bar(midi, *next(bar_notes))
+
+    try:
+        while True:
+            batch = await queue.get()
+            if isinstance(batch, Exception):
+                raise batch
+            if not batch:
+                break
+            await _call(executor, encode_batch, batch)
+            if keep_bars:
+                generated.extend(batch)
+        await _call(executor, midi.close)
+    finally:
+        producer.cancel()
+    return generated
+
+
+async def _generate(seed: str, output_file, executor, options: dict) -> Processors.ProcessorResults:
+    randoms = Pipeline.stage_randoms(seed, options.get('chunk_bars', 0) > 0)
+    results = Processors.ProcessorResults()
+    processors = Pipeline.build_processors(results, output_file, seed=seed, randoms=randoms, **options)
+    for processor in processors[:3]:
+        await _call(executor, processor.process)
+
+    bar_processor, output_processors = processors[3], processors[4:]
+    streaming = options.get('streaming', False)
+    midi_processor = output_processors[0] if output_processors else None
+    if not isinstance(midi_processor, Processors.MidiGeneratorProcessor) or midi_processor.backend != "native":
+        # nothing to overlap, the stages run one after another like the synchronous path
+        for processor in [bar_processor] + output_processors:
+            await _call(executor, processor.process)
+        return results
+
+    stream = midi_processor.output_file
+    if not hasattr(stream, "write"):
+        stream = await _call(executor, open, stream, "wb")
+    try:
+        bars = await _write_midi(executor, midi_processor, bar_processor.generate_bars(), stream, not streaming)
+    except BaseException:
+        if stream is not midi_processor.output_file:
+            # no truncated files after a failure, cancellation or timeout
+            stream.close()
+            os.remove(midi_processor.output_file)
+        raise
+    if stream is not midi_processor.output_file:
+        await _call(executor, stream.close)
+    results.bars = bars
+    for processor in output_processors[1:]:
+        await _call(executor, processor.process)
+    return results
+
+
+async def generate_async(seed: str, output_file, timeout: float = None, executor: ThreadPoolExecutor = None,
+                         **options) -> Processors.ProcessorResults:
+    # Pipeline.generate without blocking the event loop: stages run in a thread pool and the
+    # native MIDI stage encodes and writes bars as they are generated, with the same output.
+    # Cancelling the task (or exceeding `timeout` seconds, which raises TimeoutError) stops
+    # generation after the current batch of bars and removes a partially written file.
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        return await asyncio.wait_for(_generate(seed, output_file, executor, options), timeout)
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+
+
+async def generate_bytes_async(seed: str, timeout: float = None, executor: ThreadPoolExecutor = None,
+                               **options) -> bytes:
+    midi_f = io.BytesIO()
+    await generate_async(seed, midi_f, timeout, executor, **options)
+    return midi_f.getvalue()
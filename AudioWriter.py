@@ -0,0 +1,111 @@
+import struct
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, only audio rendering needs it
+    numpy = None
+
+WAVETABLE_SIZE = 2048
+
+
+def note_frequency(pitch: int) -> float:
+    return 440.0 * 2 ** ((pitch - 69) / 12)
+
+
+class Voice:
+    # a wavetable of one cycle with the given harmonics and an attack/decay/sustain/release envelope (seconds)
+
+    def __init__(self, harmonics: list, attack: float, decay: float, sustain: float, release: float):
+        phases = numpy.arange(0, WAVETABLE_SIZE) * (2 * numpy.pi / WAVETABLE_SIZE)
+        table = sum(amplitude * numpy.sin(phases * (ndx + 1)) for ndx, amplitude in enumerate(harmonics))
+        self.wavetable = (table / numpy.abs(table).max()).astype(numpy.float32)
+        self.attack = attack
+        self.decay = decay
+        self.sustain = sustain
+        self.release = release
+
+    def render(self, pitch: int, velocity: int, length: int, sample_rate: int):
+        # samples of a note lasting `length` samples, followed by its release
+        release_length = int(self.release * sample_rate)
+        times = numpy.arange(0, length + release_length, dtype=numpy.float32) / sample_rate
+        envelope = numpy.where(times < self.attack, times / self.attack,
+                               self.sustain + (1 - self.sustain) * numpy.exp((self.attack - times) / self.decay))
+        if release_length > 0:
+            envelope[length:] = envelope[length - 1] * numpy.linspace(1, 0, release_length, dtype=numpy.float32)
+        table_step = note_frequency(pitch) * WAVETABLE_SIZE / sample_rate
+        table_ndxs = (numpy.arange(0, len(times)) * table_step).astype(numpy.int64) % WAVETABLE_SIZE
+        return self.wavetable[table_ndxs] * envelope * (min(velocity, 127) / 127)
+
+
+class PcmWriter:
+    # mono 16-bit PCM encoder (a WAV file or raw samples) mixing notes as they come.
+    # Like SmfWriter it keeps only samples which can still change: `flush` writes
+    # everything before the given time, so memory is bounded by the longest note.
+    # WAV sizes are patched at `close`; streams which can not seek get the
+    # "unknown size" header used by streaming audio tools.
+
+    def __init__(self, stream, sample_rate=44100, wav=True, gain=0.2):
+        if numpy is None:
+            raise ValueError("Audio rendering requires numpy.")
+        self.stream = stream
+        self.sample_rate = sample_rate
+        self.wav = wav
+        self.gain = gain
+        self.mix = numpy.zeros(0, dtype=numpy.float32)
+        self.mix_start = 0  # sample index of mix[0]
+        self.data_length = 0
+        self.closed = False
+        try:
+            self.seekable = stream.seekable()
+        except (AttributeError, OSError):
+            self.seekable = False
+
+        if self.wav:
+            unknown_size = 0 if self.seekable else 0xFFFFFFFF
+            self.header_position = self.stream.tell() if self.seekable else 0
+            self.stream.write(b"RIFF" + struct.pack("<L", unknown_size) + b"WAVE"
+                              + b"fmt " + struct.pack("<LHHLLHH", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16)
+                              + b"data" + struct.pack("<L", unknown_size))
+
+    def seconds_to_sample(self, seconds: float) -> int:
+        return int(round(seconds * self.sample_rate))
+
+    def add_note(self, start: float, pitch: int, velocity: int, length: float, voice: Voice):
+        start_sample = self.seconds_to_sample(start)
+        if start_sample < self.mix_start:
+            raise ValueError("Note placed before already written samples.")
+        samples = voice.render(pitch, velocity, max(1, self.seconds_to_sample(length)), self.sample_rate)
+        offset = start_sample - self.mix_start
+        if offset + len(samples) > len(self.mix):
+            grown = numpy.zeros(max(offset + len(samples), 2 * len(self.mix)), dtype=numpy.float32)
+            grown[:len(self.mix)] = self.mix
+            self.mix = grown
+        self.mix[offset:offset + len(samples)] += samples
+
+    def flush(self, until: float = None):
+        # writes every sample before `until` seconds (all when None)
+        count = len(self.mix) if until is None else self.seconds_to_sample(until) - self.mix_start
+        if count <= 0:
+            return
+        samples = self.mix[:count]
+        if count > len(samples):  # silence after the last note
+            samples = numpy.concatenate((samples, numpy.zeros(count - len(samples), dtype=numpy.float32)))
+        pcm = (numpy.clip(samples * self.gain, -1, 1) * 32767).astype("<i2").tobytes()
+        self.stream.write(pcm)
+        self.data_length += len(pcm)
+        self.mix = self.mix[count:]
+        self.mix_start += count
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        if self.wav and self.seekable:
+            end_position = self.stream.tell()
+            self.stream.seek(self.header_position + 4)
+            self.stream.write(struct.pack("<L", 36 + self.data_length))
+            self.stream.seek(self.header_position + 40)
+            self.stream.write(struct.pack("<L", self.data_length))
+            self.stream.seek(end_position)
+        self.stream.flush()
+        self.closed = True
@@ -0,0 +1,96 @@
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import SeedRandomizer
+import Pipeline
+import OutputCache
+import DatasetExport
+
+
+def read_seeds(seeds_file: str) -> list:
+    with open(seeds_file) as seeds_f:
+        return [line.strip() for line in seeds_f if line.strip() != ""]
+
+
+def random_seeds(count: int) -> list:
+    return [SeedRandomizer.generate_seed() for _ in range(0, count)]
+
+
+def _generate_job(seed: str, output_file: str, options: dict, cache: OutputCache.OutputCache = None):
+    start = time.perf_counter()
+    if cache is not None:
+        midi_bytes = cache.generate(seed, **options)
+        with open(output_file, "wb") as midi_f:
+            midi_f.write(midi_bytes)
+    else:
+        Pipeline.generate(seed, output_file, **options)
+    return seed, output_file, os.getpid(), time.perf_counter() - start
+
+
+def generate_batch(seeds: list, output_dir: str, options: dict, workers: int = None,
+                   cache: OutputCache.OutputCache = None) -> dict:
+    os.makedirs(output_dir, exist_ok=True)
+    stats = {
+        'melodies': 0,
+        'wall_time': 0.0,
+        'workers': {}
+    }
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=Pipeline.silence_worker) as executor:
+        jobs = [executor.submit(_generate_job, seed, os.path.join(output_dir, seed + ".mid"), options, cache)
+                for seed in seeds]
+        for job in as_completed(jobs):
+            seed, output_file, worker_pid, job_time = job.result()
+            logging.info("Seed " + seed + " -> " + output_file)
+            worker_stats = stats['workers'].setdefault(worker_pid, {'melodies': 0, 'time': 0.0})
+            worker_stats['melodies'] += 1
+            worker_stats['time'] += job_time
+            stats['melodies'] += 1
+    stats['wall_time'] = time.perf_counter() - start
+    return stats
+
+
+def _export_job(seeds: list, options: dict) -> tuple:
+    start = time.perf_counter()
+    collector = DatasetExport.MelodyCollector()
+    for seed in seeds:
+        Pipeline.generate(seed, None, midi=False, dataset_sink=collector, **options)
+    return collector.melodies, os.getpid(), time.perf_counter() - start
+
+
+def export_batch(seeds: list, dataset_dir: str, options: dict, workers: int = None,
+                 shard_rows: int = 1 << 20, seeds_per_job: int = 16, batch_pitches=False) -> dict:
+    # melodies appended to a sharded columnar dataset instead of MIDI files, in seed order
+    writer = DatasetExport.DatasetWriter(dataset_dir, shard_rows, batch_pitches)
+    stats = {
+        'melodies': 0,
+        'wall_time': 0.0,
+        'workers': {}
+    }
+    start = time.perf_counter()
+    seed_chunks = [seeds[ndx:ndx + seeds_per_job] for ndx in range(0, len(seeds), seeds_per_job)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=Pipeline.silence_worker) as executor:
+        for melodies, worker_pid, job_time in executor.map(_export_job, seed_chunks, [options] * len(seed_chunks)):
+            for seed, columns, ticks_per_bar in melodies:
+                writer.append(seed, columns, ticks_per_bar)
+            worker_stats = stats['workers'].setdefault(worker_pid, {'melodies': 0, 'time': 0.0})
+            worker_stats['melodies'] += len(melodies)
+            worker_stats['time'] += job_time
+            stats['melodies'] += len(melodies)
+    writer.close()
+    logging.info("Dataset " + dataset_dir + ": " + str(writer.row_count) + " notes in "
+                 + str(len(writer.shards)) + " shards")
+    stats['wall_time'] = time.perf_counter() - start
+    return stats
+
+
+def print_stats(stats: dict):
+    wall_time = stats['wall_time']
+    print("Melodies: " + str(stats['melodies']) + " in " + format(wall_time, ".2f") + "s ("
+          + format(stats['melodies'] / wall_time if wall_time > 0 else 0.0, ".2f") + " melodies/s)")
+    for worker_ndx, worker_stats in enumerate(stats['workers'].values()):
+        print("Worker " + str(worker_ndx) + ": " + str(worker_stats['melodies']) + " melodies, "
+              + format(worker_stats['time'], ".2f") + "s, "
+              + format(worker_stats['time'] / worker_stats['melodies'], ".4f") + "s per melody")
@@ -0,0 +1,100 @@
+try:
+    import numpy
+except ImportError:  # numpy is optional, only batch generation needs it
+    numpy = None
+
+from MusicElements import Tone, ToneType, NoteTransitionTable, note_transitions
+
+PITCH_COUNT = 128
+# ordered by tone_id: 0-11 major, 12-23 minor tones
+TONES = [Tone(tone_index, tone_type) for tone_type in (ToneType.Dur, ToneType.Mol) for tone_index in range(0, 12)]
+SILENT_PITCH = -1
+
+
+class BatchPitchEngine:
+    # advances the pitch Markov chain of many independent melodies at once;
+    # every (tone, previous pitch) row of NoteTransitionTable becomes a row of
+    # cumulative weights, so one step is a gather and a vectorized comparison.
+    # Used by dataset export with `--batch-pitches` and by callers with their own note
+    # layouts; the generation pipeline draws note by note from the seeded random streams.
+
+    def __init__(self, transitions: NoteTransitionTable = note_transitions):
+        if numpy is None:
+            raise ValueError("The batch pitch engine requires numpy.")
+        self.transitions = transitions
+        # [harmonic/non-harmonic, tone, previous pitch, candidate]; rows are padded
+        # with 1.0 so the count of cumulative weights below a draw is the candidate index
+        width = max(len(transitions.candidates(tone, pitch)) for tone in TONES for pitch in range(0, PITCH_COUNT))
+        self.cumulative = numpy.ones((2, len(TONES), PITCH_COUNT, width))
+        self.candidate_pitches = numpy.zeros((2, len(TONES), PITCH_COUNT, width), dtype=numpy.int16)
+        # harmonic rows without candidates fall back to the primary note of the tone (like a missing
+        # harmonic_sampler), a step hitting an empty non-harmonic row raises like non_harmonic_sampler
+        self.empty = numpy.zeros((2, len(TONES), PITCH_COUNT), dtype=bool)
+        self.primary_pitches = numpy.array([tone.get_note_index_by_octave(5) for tone in TONES])
+        self.built = numpy.zeros(len(TONES), dtype=bool)
+
+    def build_tone(self, tone_ndx: int):
+        tone = TONES[tone_ndx]
+        for previous_pitch in range(0, PITCH_COUNT):
+            for kind, candidates in enumerate((self.transitions.harmonic_candidates(tone, previous_pitch),
+                                               self.transitions.non_harmonic_candidates(tone, previous_pitch))):
+                if not candidates:
+                    self.empty[kind, tone_ndx, previous_pitch] = True
+                    continue
+                weights = numpy.cumsum([note['probability'] for note in candidates])
+                row = self.cumulative[kind, tone_ndx, previous_pitch]
+                row[:len(candidates)] = weights / weights[-1]
+                row[len(candidates) - 1] = 1.0  # no draw can pass the last candidate because of rounding
+                self.candidate_pitches[kind, tone_ndx, previous_pitch, :len(candidates)] = \
+                    [note['note_index'] for note in candidates]
+        self.built[tone_ndx] = True
+
+    def build(self, tone_ids):
+        for tone_ndx in numpy.unique(tone_ids):
+            if not self.built[tone_ndx]:
+                self.build_tone(int(tone_ndx))
+
+    def step(self, tone_ids, previous_pitches, harmonic, rng) -> "numpy.ndarray":
+        # next pitch of every melody; `harmonic` selects the harmonic or the non-harmonic rules
+        if not self.built[tone_ids].all():
+            self.build(tone_ids)
+        kinds = numpy.where(harmonic, 0, 1)
+        previous_pitches = numpy.clip(previous_pitches, 0, PITCH_COUNT - 1)
+        rows = self.cumulative[kinds, tone_ids, previous_pitches]
+        draws = rng.random(len(rows))
+        candidate_ndxs = (rows < draws[:, None]).sum(axis=1)
+        pitches = self.candidate_pitches[kinds, tone_ids, previous_pitches, candidate_ndxs]
+        empty = self.empty[kinds, tone_ids, previous_pitches]
+        if (empty & (kinds == 1)).any():
+            raise ValueError("Sequence can not be empty.")
+        return numpy.where(empty, self.primary_pitches[tone_ids], pitches)
+
+    def assign_pitches(self, tone_ids, harmonic_flags, silent_flags, start_pitches, rng=None,
+                       first_fixed=True) -> "numpy.ndarray":
+        # pitches of `melodies x notes` arrays, rules as in the note by note generators: silent notes
+        # get SILENT_PITCH and do not move the chain; with `first_fixed` the first note gets the start
+        # pitch (the first note of a melody), otherwise it follows the start pitch as its previous note
+        harmonic_flags = numpy.asarray(harmonic_flags, dtype=bool)
+        silent_flags = numpy.broadcast_to(numpy.asarray(silent_flags, dtype=bool), harmonic_flags.shape)
+        tone_ids = numpy.broadcast_to(numpy.asarray(tone_ids), harmonic_flags.shape)
+        previous_pitches = numpy.array(numpy.broadcast_to(start_pitches, harmonic_flags.shape[:1]))
+        if rng is None or isinstance(rng, int):
+            rng = numpy.random.default_rng(rng)
+
+        pitches = numpy.full(harmonic_flags.shape, SILENT_PITCH, dtype=numpy.int16)
+        for note_ndx in range(0, harmonic_flags.shape[1]):
+            if note_ndx == 0 and first_fixed:
+                pitches[:, 0] = previous_pitches
+                continue
+            sounding = ~silent_flags[:, note_ndx]
+            next_pitches = self.step(tone_ids[sounding, note_ndx], previous_pitches[sounding],
+                                     harmonic_flags[sounding, note_ndx], rng)
+            pitches[sounding, note_ndx] = next_pitches
+            previous_pitches[sounding] = next_pitches
+        return pitches
+
+    @staticmethod
+    def note_flags(notes: list) -> tuple:
+        # harmonic and silent flags of a note sequence, e.g. rhythm element templates
+        return (numpy.array([note.harmonic_flag for note in notes], dtype=bool),
+                numpy.array([note.silent for note in notes], dtype=bool))
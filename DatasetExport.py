@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import array
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, only memory-mapped reading and batch pitches need it
+    numpy = None
+
+import SeedRandomizer
+from MusicElements import tone_id
+
+# column name -> array typecode; one row per note
+COLUMNS = {
+    'seed': "I",  # index into the `seeds` list of the shard manifest
+    'bar': "I",
+    'tick': "Q",  # offset from the melody start, in bar size units (see `ticks_per_bar`)
+    'pitch': "h",
+    'length': "H",
+    'silent': "B",
+    'harmonic': "B",
+    'tone': "B"  # tone of the note's bar segment: 0-11 major, 12-23 minor
+}
+NUMPY_TYPES = {"I": "u4", "Q": "u8", "h": "i2", "H": "u2", "B": "u1"}
+COLUMN_ALIGNMENT = 64
+MANIFEST_VERSION = 1
+
+
+def melody_columns(bars, bar_size: int) -> dict:
+    # columns of one melody (without the seed column)
+    columns = {name: array.array(typecode) for name, typecode in COLUMNS.items() if name != 'seed'}
+    bar_column, tick_column, pitch_column = columns['bar'], columns['tick'], columns['pitch']
+    length_column, silent_column = columns['length'], columns['silent']
+    harmonic_column, tone_column = columns['harmonic'], columns['tone']
+    for bar_ndx, bar in enumerate(bars):
+        bar_tick = bar_ndx * bar_size
+        for offset, note in bar.notes.items():
+            bar_column.append(bar_ndx)
+            tick_column.append(bar_tick + int(offset))
+            pitch_column.append(note.pitch)
+            length_column.append(note.length)
+            silent_column.append(note.silent)
+            harmonic_column.append(note.harmonic_flag)
+            tone_column.append(tone_id(bar.get_tone_for_note_index(offset)))
+    return columns
+
+
+class MelodyCollector:
+    # keeps melody columns as bytes, e.g. to send them from a worker process to the writer
+    def __init__(self):
+        self.melodies = []
+
+    def append(self, seed: str, columns: dict, ticks_per_bar: int):
+        self.melodies.append((seed, {name: column.tobytes() for name, column in columns.items()}, ticks_per_bar))
+
+
+class DatasetWriter:
+    # appends melodies to column buffers and writes them as shards of `shard_rows` notes:
+    # `shard-NNNNN.bin` holds every column contiguously (aligned for memory mapping) and
+    # `shard-NNNNN.json` is its manifest; `manifest.json` lists the shards of the dataset.
+    # With `batch_pitches` the pitch column of every shard is drawn again by BatchPitchEngine,
+    # all melodies of the shard at once; such pitches do not match MIDI files of the same seeds
+
+    def __init__(self, directory: str, shard_rows: int = 1 << 20, batch_pitches=False):
+        self.directory = directory
+        self.shard_rows = shard_rows
+        self.pitch_engine = None
+        if batch_pitches:
+            import BatchPitchEngine
+            self.pitch_engine = BatchPitchEngine.BatchPitchEngine()
+        self.shards = []
+        self.ticks_per_bar = None
+        self.melody_count = 0
+        self.row_count = 0
+        os.makedirs(directory, exist_ok=True)
+        self._open_existing()
+        self._new_shard()
+
+    def _open_existing(self):
+        # a dataset written before is continued with new shards, other files are never overwritten
+        manifest_file = os.path.join(self.directory, "manifest.json")
+        if not os.path.exists(manifest_file):
+            if os.listdir(self.directory):
+                raise ValueError("Dataset directory " + self.directory + " is not empty and has no manifest.json")
+            return
+        with open(manifest_file) as manifest_f:
+            manifest = json.load(manifest_f)
+        if manifest.get('version') != MANIFEST_VERSION or manifest.get('columns') != list(COLUMNS.keys()):
+            raise ValueError("Dataset " + self.directory + " was written in another format.")
+        self.shards = manifest['shards']
+        self.ticks_per_bar = manifest['ticks_per_bar']
+        self.melody_count = manifest['melodies']
+        self.row_count = manifest['rows']
+
+    def _new_shard(self):
+        self.columns = {name: array.array(typecode) for name, typecode in COLUMNS.items()}
+        self.seeds = []
+
+    def append(self, seed: str, columns: dict, ticks_per_bar: int):
+        # `columns` are melody_columns arrays or their bytes
+        if self.ticks_per_bar is None:
+            self.ticks_per_bar = ticks_per_bar
+        elif ticks_per_bar != self.ticks_per_bar:
+            raise ValueError("Melodies of one dataset must have the same bar size.")
+        for name, column in columns.items():
+            if isinstance(column, array.array):
+                self.columns[name].extend(column)
+            else:
+                self.columns[name].frombytes(column)
+        row_count = len(self.columns['bar']) - len(self.columns['seed'])
+        self.columns['seed'].extend(array.array(COLUMNS['seed'], [len(self.seeds)]) * row_count)
+        self.seeds.append(seed)
+        self.melody_count += 1
+        self.row_count += row_count
+        if len(self.columns['seed']) >= self.shard_rows:
+            self.flush()
+
+    def flush(self):
+        # writes buffered melodies as one shard
+        rows = len(self.columns['seed'])
+        if rows == 0:
+            return
+        shard_name = "shard-" + format(len(self.shards), "05d")
+        if self.pitch_engine is not None:
+            self.columns['pitch'] = self.batch_pitches(shard_name)
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'rows': rows,
+            'ticks_per_bar': self.ticks_per_bar,
+            'seeds': self.seeds,
+            'batch_pitches': self.pitch_engine is not None,
+            'columns': {}
+        }
+        with open(os.path.join(self.directory, shard_name + ".bin"), "wb") as shard_f:
+            for name, column in self.columns.items():
+                padding = -shard_f.tell() % COLUMN_ALIGNMENT
+                shard_f.write(b"\x00" * padding)
+                manifest['columns'][name] = {
+                    'dtype': ("<" if sys.byteorder == "little" else ">") + NUMPY_TYPES[column.typecode],
+                    'offset': shard_f.tell()
+                }
+                column.tofile(shard_f)
+        # the manifest is written last, readers never see a shard without its data
+        with open(os.path.join(self.directory, shard_name + ".json"), "w") as manifest_f:
+            json.dump(manifest, manifest_f)
+        self.shards.append({'name': shard_name, 'rows': rows, 'melodies': len(self.seeds)})
+        self._new_shard()
+
+    def batch_pitches(self, shard_name: str) -> array.array:
+        # pitch column of the buffered melodies drawn as `melodies x notes` arrays (shorter melodies
+        # are padded with silent notes); the first note keeps the primary note of its tone and silent
+        # notes keep their pitch. The draws are seeded by the shard name and the seeds of the shard
+        seed_ndxs = numpy.frombuffer(self.columns['seed'], dtype=NUMPY_TYPES["I"])
+        note_counts = numpy.bincount(seed_ndxs, minlength=len(self.seeds))
+        starts = numpy.concatenate(([0], numpy.cumsum(note_counts)[:-1]))
+        note_ndxs = numpy.arange(len(seed_ndxs)) - starts[seed_ndxs]
+        shape = (len(self.seeds), int(note_counts.max()))
+        tone_ids = numpy.zeros(shape, dtype=numpy.intp)
+        harmonic_flags = numpy.zeros(shape, dtype=bool)
+        silent_flags = numpy.ones(shape, dtype=bool)
+        tone_ids[seed_ndxs, note_ndxs] = numpy.frombuffer(self.columns['tone'], dtype=numpy.uint8)
+        harmonic_flags[seed_ndxs, note_ndxs] = numpy.frombuffer(self.columns['harmonic'], dtype=numpy.uint8)
+        silent_flags[seed_ndxs, note_ndxs] = numpy.frombuffer(self.columns['silent'], dtype=numpy.uint8)
+        start_pitches = self.pitch_engine.primary_pitches[tone_ids[:, 0]]
+        rng = numpy.random.default_rng(SeedRandomizer.derive_seed(shard_name, "pitches", *self.seeds))
+        pitches = self.pitch_engine.assign_pitches(tone_ids, harmonic_flags, silent_flags, start_pitches, rng)
+        pitches = pitches[seed_ndxs, note_ndxs]
+        silent = silent_flags[seed_ndxs, note_ndxs] & (note_ndxs > 0)
+        old_pitches = numpy.frombuffer(self.columns['pitch'], dtype=numpy.int16)
+        return array.array(COLUMNS['pitch'], numpy.where(silent, old_pitches, pitches).astype(numpy.int16).tobytes())
+
+    def close(self):
+        self.flush()
+        with open(os.path.join(self.directory, "manifest.json"), "w") as manifest_f:
+            json.dump({
+                'version': MANIFEST_VERSION,
+                'columns': list(COLUMNS.keys()),
+                'ticks_per_bar': self.ticks_per_bar,
+                'melodies': self.melody_count,
+                'rows': self.row_count,
+                'shards': self.shards
+            }, manifest_f, indent=2)
+
+
+def open_shard(directory: str, shard_name: str) -> tuple:
+    # (manifest, memory-mapped columns) of one shard
+    if numpy is None:
+        raise ValueError("Reading shards requires numpy.")
+    with open(os.path.join(directory, shard_name + ".json")) as manifest_f:
+        manifest = json.load(manifest_f)
+    columns = {name: numpy.memmap(os.path.join(directory, shard_name + ".bin"), dtype=column['dtype'], mode="r",
+                                  offset=column['offset'], shape=(manifest['rows'],))
+               for name, column in manifest['columns'].items()}
+    return manifest, columns
+
+
+def read_dataset(directory: str):
+    # yields (manifest, columns) of every shard
+    with open(os.path.join(directory, "manifest.json")) as manifest_f:
+        manifest = json.load(manifest_f)
+    for shard in manifest['shards']:
+        yield open_shard(directory, shard['name'])
@@ -0,0 +1,201 @@
+import json
+import asyncio
+import logging
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+
+import Pipeline
+import OutputCache
+
+WARM_UP_SEED = "warmup"
+
+
+class RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+    503: "Service Unavailable"
+}
+
+
+def _warm_worker(elements_file: str):
+    # compile elements and fill tone and transition tables once per worker
+    Pipeline.silence_worker()
+    Pipeline.generate_bytes(WARM_UP_SEED, bars=8, elements_file=elements_file)
+
+
+def _generate_job(seed: str, options: dict, elements_file: str, cache: OutputCache.OutputCache = None) -> bytes:
+    if cache is not None:
+        return cache.generate(seed, elements_file=elements_file, **options)
+    return Pipeline.generate_bytes(seed, elements_file=elements_file, **options)
+
+
+def parse_generation_query(query: str) -> tuple:
+    # the same parameters as the command line: seed, bars, tones, bpm, continuous, rich
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    seed = params.get("seed", "")
+    if seed == "":
+        raise RequestError(400, "Parameter `seed` is required.")
+
+    def int_param(name, default, minimum, maximum):
+        try:
+            value = int(params.get(name, default))
+        except ValueError:
+            raise RequestError(400, "Parameter `" + name + "` must be an integer.")
+        if not minimum <= value <= maximum:
+            raise RequestError(400, "Parameter `" + name + "` must be between " + str(minimum)
+                               + " and " + str(maximum) + ".")
+        return value
+
+    def flag_param(name):
+        return params.get(name, "0").lower() in ("1", "true", "yes", "on")
+
+    options = {
+        'bars': int_param("bars", 32, 1, 100000),
+        'tones': params.get("tones", ""),
+        'bpm': int_param("bpm", 120, 1, 1000),
+        'continuous': flag_param("continuous"),
+        'rich': flag_param("rich")
+    }
+    return seed, options
+
+
+class GenerationServer:
+    # asyncio HTTP front end over a pool of warm worker processes;
+    # at most `max_pending` generations are accepted, the rest get 503
+
+    def __init__(self, workers: int = None, max_pending: int = 64, elements_file: str = Pipeline.ELEMENTS_FILE,
+                 cache: OutputCache.OutputCache = None):
+        self.workers = workers
+        self.cache = cache
+        self.max_pending = max_pending
+        self.elements_file = elements_file
+        self.executor = None
+        self.pending = 0
+        self.served = 0
+        self.rejected = 0
+
+    def start_executor(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_warm_worker,
+                                            initargs=(self.elements_file,))
+
+    async def generate(self, seed: str, options: dict) -> bytes:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise RequestError(503, "Too many pending generations.")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            try:
+                midi_bytes = await loop.run_in_executor(self.executor, _generate_job, seed, options,
+                                                        self.elements_file, self.cache)
+            except (KeyError, ValueError, IndexError) as error:  # e.g. unknown tone names
+                raise RequestError(400, "Generation failed: " + str(error))
+            self.served += 1
+            return midi_bytes
+        finally:
+            self.pending -= 1
+
+    def status(self) -> dict:
+        return {
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'served': self.served,
+            'rejected': self.rejected
+        }
+
+    async def handle_request(self, method: str, target: str) -> tuple:
+        url = urlsplit(target)
+        if url.path == "/status":
+            return 200, "application/json", json.dumps(self.status()).encode()
+        if url.path != "/generate":
+            raise RequestError(404, "Unknown path " + url.path)
+        if method != "GET":
+            raise RequestError(405, "Only GET is supported.")
+        seed, options = parse_generation_query(url.query)
+        return 200, "audio/midi", await self.generate(seed, options)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    header_line = await reader.readline()
+                    if header_line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header_line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if headers.get("content-length", "0").isdigit() and int(headers.get("content-length", "0")) > 0:
+                    await reader.readexactly(int(headers["content-length"]))  # bodies are not used
+
+                try:
+                    parts = request_line.decode("latin-1").split()
+                    if len(parts) != 3:
+                        raise RequestError(400, "Malformed request line.")
+                    method, target, version = parts
+                    status, content_type, body = await self.handle_request(method, target)
+                except RequestError as error:
+                    version = "HTTP/1.1"
+                    status, content_type, body = error.status, "text/plain", (error.message + "\n").encode()
+                except Exception:
+                    logging.exception("Generation request failed")
+                    version = "HTTP/1.1"
+                    status, content_type, body = 500, "text/plain", b"Internal error\n"
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                response_headers = [
+                    "HTTP/1.1 " + str(status) + " " + HTTP_REASONS[status],
+                    "Content-Type: " + content_type,
+                    "Content-Length: " + str(len(body)),
+                    "Connection: " + ("keep-alive" if keep_alive else "close")
+                ]
+                if status == 503:
+                    response_headers.append("Retry-After: 1")
+                writer.write(("\r\n".join(response_headers) + "\r\n\r\n").encode("latin-1") + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000, unix_socket: str = None):
+        self.start_executor()
+        try:
+            if unix_socket is not None:
+                server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+                print("Serving on unix socket " + unix_socket)
+            else:
+                server = await asyncio.start_server(self.handle_connection, host, port)
+                print("Serving on http://" + host + ":" + str(port))
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+
+def run_server(address: str, workers: int = None, max_pending: int = 64, cache: OutputCache.OutputCache = None):
+    # `address` is HOST:PORT, or a path for a unix socket
+    server = GenerationServer(workers, max_pending, cache=cache)
+    if "/" in address:
+        coroutine = server.serve(unix_socket=address)
+    else:
+        host, _, port = address.rpartition(":")
+        coroutine = server.serve(host or "127.0.0.1", int(port))
+    try:
+        asyncio.run(coroutine)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,56 @@
+import sys
+import json
+import time
+
+# hot-path counters, increased by the code that does the counted work
+counters = {
+    'probability_lists_built': 0,
+    'sampler_draws': 0,
+    'notes_copied': 0,
+    'random_choice_fallbacks': 0
+}
+
+
+class PipelineMetrics:
+    # wall time, CPU time, allocated blocks and counter deltas of every stage;
+    # in streaming mode bar generation is accounted to the MIDI stage
+
+    def __init__(self):
+        self.stages = []
+
+    def measure(self, processor):
+        counters_before = dict(counters)
+        blocks_before = sys.getallocatedblocks()
+        cpu_before = time.process_time()
+        wall_before = time.perf_counter()
+        processor.process()
+        wall_time = time.perf_counter() - wall_before
+        cpu_time = time.process_time() - cpu_before
+        self.stages.append({
+            'stage': type(processor).__name__,
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'allocated_blocks': sys.getallocatedblocks() - blocks_before,
+            'counters': {name: value - counters_before[name] for name, value in counters.items()}
+        })
+
+    def to_dict(self) -> dict:
+        total_counters = dict.fromkeys(counters, 0)
+        for stage in self.stages:
+            for name, value in stage['counters'].items():
+                total_counters[name] += value
+        return {
+            'stages': self.stages,
+            'total': {
+                'wall_time': sum(stage['wall_time'] for stage in self.stages),
+                'cpu_time': sum(stage['cpu_time'] for stage in self.stages),
+                'allocated_blocks': sum(stage['allocated_blocks'] for stage in self.stages),
+                'counters': total_counters
+            }
+        }
+
+    def save(self, metrics_file: str, **extra):
+        report = dict(extra)
+        report.update(self.to_dict())
+        with open(metrics_file, "w") as metrics_f:
+            json.dump(report, metrics_f, indent=2)
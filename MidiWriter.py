@@ -0,0 +1,106 @@
+import heapq
+import struct
+
+
+def variable_length_quantity(value: int) -> bytes:
+    if value < 0:
+        raise ValueError("Delta time can not be negative.")
+    encoded = [value & 0x7F]
+    value >>= 7
+    while value:
+        encoded.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(encoded))
+
+
+class SmfWriter:
+    # Standard MIDI File (format 0) encoder writing events as they come.
+    # Events are queued only until `flush` passes their tick and seekable streams
+    # get the encoded track in chunks, so memory stays bounded by the notes that
+    # are still sounding; the track length header is patched once at `close`.
+    # Streams which can not seek (stdout, pipes) need the length first, they
+    # keep the encoded track in memory and get it whole on close.
+
+    def __init__(self, stream, ticks_per_beat=960, chunk_size=1 << 16):
+        self.stream = stream
+        self.ticks_per_beat = ticks_per_beat
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.track_length = 0
+        self.last_tick = 0
+        self.pending = []
+        self.event_counter = 0
+        self.closed = False
+        try:
+            self.seekable = stream.seekable()
+        except (AttributeError, OSError):
+            self.seekable = False
+
+        self.header = b"MThd" + struct.pack(">LHHH", 6, 0, 1, ticks_per_beat)
+        if self.seekable:
+            self.stream.write(self.header + b"MTrk")
+            self.length_position = self.stream.tell()
+            self.stream.write(b"\x00\x00\x00\x00")
+
+    def beat_to_tick(self, beat: float) -> int:
+        return int(round(beat * self.ticks_per_beat))
+
+    def _queue(self, tick: int, order: int, data: bytes):
+        if tick < self.last_tick:
+            raise ValueError("Event placed before already written events.")
+        # at the same tick note offs (order 0) go before everything else
+        heapq.heappush(self.pending, (tick, order, self.event_counter, data))
+        self.event_counter += 1
+
+    def add_tempo(self, tick: int, bpm: float):
+        self._queue(tick, 1, b"\xFF\x51\x03" + struct.pack(">L", int(round(60000000 / bpm)))[1:])
+
+    def add_track_name(self, tick: int, name: str):
+        encoded = name.encode("latin-1", "replace")
+        self._queue(tick, 1, b"\xFF\x03" + variable_length_quantity(len(encoded)) + encoded)
+
+    def add_program_change(self, tick: int, channel: int, program: int):
+        self._queue(tick, 1, bytes((0xC0 | channel, program)))
+
+    def add_note(self, tick: int, channel: int, pitch: int, velocity: int, duration: int):
+        if not 0 <= pitch <= 127:
+            raise ValueError("Pitch out of MIDI range.")
+        velocity = min(velocity, 127)
+        self._queue(tick, 2, bytes((0x90 | channel, pitch, velocity)))
+        self._queue(tick + duration, 0, bytes((0x80 | channel, pitch, 0)))
+
+    def flush(self, until_tick: int = None):
+        # writes every queued event placed before `until_tick` (all when None)
+        pending = self.pending
+        buffer = self.buffer
+        last_tick = self.last_tick
+        while pending and (until_tick is None or pending[0][0] < until_tick):
+            tick, _, _, data = heapq.heappop(pending)
+            buffer += variable_length_quantity(tick - last_tick)
+            buffer += data
+            last_tick = tick
+        self.last_tick = last_tick
+        if self.seekable and len(buffer) >= self.chunk_size:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        self.stream.write(self.buffer)
+        self.track_length += len(self.buffer)
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.buffer += b"\x00\xFF\x2F\x00"  # end of track
+        if self.seekable:
+            self._write_buffer()
+            end_position = self.stream.tell()
+            self.stream.seek(self.length_position)
+            self.stream.write(struct.pack(">L", self.track_length))
+            self.stream.seek(end_position)
+        else:
+            self.stream.write(self.header + b"MTrk" + struct.pack(">L", len(self.buffer)))
+            self._write_buffer()
+        self.stream.flush()
+        self.closed = True
@@ -1,27 +1,71 @@
+import bisect
+import random
 from enum import Enum
 
+import Metrics
+from SeedRandomizer import ProbabilitySampler
+
 
 class ToneType(Enum):
     Dur = 1
     Mol = 2
 
 
+# transcription names, looked up instead of built per call
+NOTE_NAMES = ("C", "C♯", "D", "E♭", "E", "F", "F♯", "G", "G♯", "A", "B♭", "H")
+PITCH_NAMES = tuple(NOTE_NAMES[pitch % 12] + str((pitch // 12) + 1) for pitch in range(0, 128))
+
+
+def mask_from_pitches(pitches) -> int:
+    mask = 0
+    for pitch in pitches:
+        if pitch >= 0:  # negative indexes are not valid MIDI pitches
+            mask |= 1 << pitch
+    return mask
+
+
+def pitches_from_mask(mask: int) -> set:
+    pitches = set()
+    pitch = 0
+    while mask:
+        if mask & 1:
+            pitches.add(pitch)
+        mask >>= 1
+        pitch += 1
+    return pitches
+
+
 class Tone:
-    def __init__(self, tone_index: int, tone_type: ToneType):
-        self.index = tone_index
-        self.type = tone_type
+    _interned = dict()
+
+    def __new__(cls, tone_index: int, tone_type: ToneType):
+        # there are only 24 tones, so every Tone is an interned singleton
+        # with its pitch sets computed once
+        key = (tone_index, tone_type)
+        tone = cls._interned.get(key)
+        if tone is None:
+            tone = super().__new__(cls)
+            tone.index = tone_index
+            tone.type = tone_type
+            tone.name = NOTE_NAMES[tone_index % 12] + ("m" if tone_type == ToneType.Mol else "")
+            tone._build_pitch_sets()
+            cls._interned[key] = tone
+        return tone
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return Tone, (self.index, self.type)
 
     def __str__(self, *args, **kwargs):
-        tone_objects = [
-            "C", "C♯", "D", "E♭", "E", "F", "F♯", "G", "G♯", "A", "B♭", "H"
-        ]
-        ret = tone_objects[self.index % 12]
-        if self.type == ToneType.Mol:
-            ret += "m"
-        return ret
+        return self.name
 
     def __eq__(self, other):
-        return self.index == other.index and self.type == other.type
+        return self is other or (self.index == other.index and self.type == other.type)
 
     def __lt__(self, other):
         return hash(self) < hash(other)
@@ -37,20 +81,15 @@ class Tone:
     def __hash__(self):
         return 10*self.index + (self._tone_type_hash())
 
-    def get_note_index_by_octave(self, octave) -> int:
-        return octave*12 + self.index
-
-    def get_harmonic_tone_indexes(self) -> set:
-        harmonic_set = set()
-        harmonic_set.add(self.index)
-        harmonic_set.add((self.index+7) % 12)
+    def _build_pitch_sets(self):
+        harmonic_tone_set = set()
+        harmonic_tone_set.add(self.index)
+        harmonic_tone_set.add((self.index+7) % 12)
         if self.type == ToneType.Dur:
-            harmonic_set.add((self.index + 4) % 12)
+            harmonic_tone_set.add((self.index + 4) % 12)
         if self.type == ToneType.Mol:
-            harmonic_set.add((self.index + 3) % 12)
-        return harmonic_set
+            harmonic_tone_set.add((self.index + 3) % 12)
 
-    def get_harmonic_note_indexes(self) -> set:
         harmonic_set = set()
         for ndx in range(0, 100, 12):
             harmonic_set.add(ndx + self.index)
@@ -59,34 +98,53 @@ class Tone:
                 harmonic_set.add(ndx + self.index + 4)
             if self.type == ToneType.Mol:
                 harmonic_set.add(ndx + self.index + 3)
-        return harmonic_set
 
-    def get_forbidden_note_indexes(self) -> set:
-        h_set = self.get_harmonic_tone_indexes()
-        f_set = set()
-        for h_note in h_set:
+        forbidden_set = set()
+        for h_note in harmonic_tone_set:
             curr_ndx = h_note - 1
             while curr_ndx < 160:
-                f_set.add(curr_ndx)
+                forbidden_set.add(curr_ndx)
                 curr_ndx += 12
             curr_ndx = h_note + 1
             while curr_ndx < 160:
-                f_set.add(curr_ndx)
+                forbidden_set.add(curr_ndx)
                 curr_ndx += 12
-        return f_set
 
-    def get_tone_note_indexes(self) -> set:
-        ret = set()
+        tone_set = set()
         for octave in range(0, 8):
             primary = self.index + octave*12
-            ret = ret.union({primary, primary + 2, primary + 5, primary + 7, primary + 11})
+            tone_set.update({primary, primary + 2, primary + 5, primary + 7, primary + 11})
             if self.type == ToneType.Dur:
-                ret.add(primary+4)
-                ret.add(primary+9)
+                tone_set.add(primary+4)
+                tone_set.add(primary+9)
             if self.type == ToneType.Mol:  # harmonic mol range !!!
-                ret.add(primary+3)
-                ret.add(primary+8)
-        return ret
+                tone_set.add(primary+3)
+                tone_set.add(primary+8)
+
+        self._harmonic_tone_indexes = frozenset(harmonic_tone_set)
+        self._harmonic_note_indexes = frozenset(harmonic_set)
+        self._forbidden_note_indexes = frozenset(forbidden_set)
+        self._tone_note_indexes = frozenset(tone_set)
+
+        # bit `n` of a mask is set when pitch `n` belongs to the set
+        self.harmonic_mask = mask_from_pitches(harmonic_set)
+        self.forbidden_mask = mask_from_pitches(forbidden_set)
+        self.tone_mask = mask_from_pitches(tone_set)
+
+    def get_note_index_by_octave(self, octave) -> int:
+        return octave*12 + self.index
+
+    def get_harmonic_tone_indexes(self) -> frozenset:
+        return self._harmonic_tone_indexes
+
+    def get_harmonic_note_indexes(self) -> frozenset:
+        return self._harmonic_note_indexes
+
+    def get_forbidden_note_indexes(self) -> frozenset:
+        return self._forbidden_note_indexes
+
+    def get_tone_note_indexes(self) -> frozenset:
+        return self._tone_note_indexes
 
     def next_tone_probability_list(self, tones: list):
         complementaries = self.complementary(self, set(tones))
@@ -127,34 +185,132 @@ class Tone:
         return alt_set
 
 
+def tone_id(tone: Tone) -> int:
+    # 0-11 major, 12-23 minor tones, e.g. for arrays indexed by tone
+    return tone.index + (12 if tone.type == ToneType.Mol else 0)
+
+
+def all_tones() -> set:
+    # always built in the same order, so iterating the set is reproducible
+    tones = set()
+    for tone_ndx in range(0, 12):
+        tones.add(Tone(tone_ndx, ToneType.Dur))
+        tones.add(Tone(tone_ndx, ToneType.Mol))
+    return tones
+
+
+class ToneProgressionTable:
+    # the next tone distribution depends only on the current tone, so the whole
+    # 24x24 transition matrix and a sampler per row are computed once;
+    # samplers keep the item order of next_tone_probability_list, so draws do not change
+
+    def __init__(self, tones: set):
+        self.tones = sorted(tones, key=lambda tone: (tone.type.value, tone.index))
+        self.tone_ndxs = {tone: ndx for ndx, tone in enumerate(self.tones)}
+        self.matrix = [[0.0] * len(self.tones) for _ in self.tones]
+        self._samplers = dict()
+        for tone in self.tones:
+            probability_list = tone.next_tone_probability_list(tones)
+            row = self.matrix[self.tone_ndxs[tone]]
+            for item in probability_list:
+                row[self.tone_ndxs[item['tone']]] += item['probability']
+            self._samplers[tone] = ProbabilitySampler([item['tone'] for item in probability_list],
+                                                      [item['probability'] for item in probability_list])
+
+    def probability(self, from_tone: Tone, to_tone: Tone) -> float:
+        return self.matrix[self.tone_ndxs[from_tone]][self.tone_ndxs[to_tone]]
+
+    def sampler(self, tone: Tone) -> ProbabilitySampler:
+        return self._samplers[tone]
+
+    def progression(self, first_tone: Tone, length: int, rng=random) -> list:
+        tone_sequence = [first_tone]
+        for _ in range(1, length):
+            tone_sequence.append(self._samplers[tone_sequence[-1]].draw(rng))
+        return tone_sequence
+
+
+tone_progressions = ToneProgressionTable(all_tones())
+
+
+# atomic rhythm values shared by all notes; a note keeps only the index
+_atomics = []
+_atomic_ids = dict()
+
+
+def atomic_id(atomic) -> int:
+    if atomic is None:
+        return -1
+    key = tuple(sorted(atomic.items()))
+    ndx = _atomic_ids.get(key)
+    if ndx is None:
+        ndx = len(_atomics)
+        _atomics.append(dict(atomic))
+        _atomic_ids[key] = ndx
+    return ndx
+
+
+def _restore_note(length, atomic, pitch, velocity, silent, harmonic_flag, finalized):
+    note = Note(length, atomic)
+    note.pitch = pitch
+    note.velocity = velocity
+    note.silent = silent
+    note.harmonic_flag = harmonic_flag
+    note.finalized = finalized
+    return note
+
+
 class Note:
+    __slots__ = ('silent', 'pitch', 'velocity', 'length', 'atomic_id', 'harmonic_flag', 'finalized')
+
     def __init__(self, length, atomic):
         self.silent = False
         self.pitch = 60  # C5 as default by MIDI standard
         self.velocity = 128  # we consider all sounds to be equally-loud
         self.length = length
-        self.atomic = atomic
+        self.atomic_id = atomic_id(atomic)
         self.harmonic_flag = False
         self.finalized = False
 
+    @property
+    def atomic(self):
+        return _atomics[self.atomic_id] if self.atomic_id >= 0 else None
+
+    def __copy__(self):
+        Metrics.counters['notes_copied'] += 1
+        copied = Note.__new__(Note)
+        copied.silent = self.silent
+        copied.pitch = self.pitch
+        copied.velocity = self.velocity
+        copied.length = self.length
+        copied.atomic_id = self.atomic_id
+        copied.harmonic_flag = self.harmonic_flag
+        copied.finalized = self.finalized
+        return copied
+
+    def __reduce__(self):
+        # atomic ids are per process, pickles carry the atomic itself
+        return _restore_note, (self.length, self.atomic, self.pitch, self.velocity,
+                               self.silent, self.harmonic_flag, self.finalized)
+
     def get_tone_index(self):
         return self.pitch % 12
 
     def get_tone_from(self, tones: set):
         return next((t for t in tones if t.index == self.pitch % 12))
 
-    def get_neighbours(self, tone: Tone, bottom_border=52, top_border=84, gap=12):
-        neighbours_set = set()
+    def get_neighbours_mask(self, tone: Tone, bottom_border=52, top_border=84, gap=12) -> int:
         bottom_border = max(bottom_border, self.pitch-gap)
         top_border = min(top_border, self.pitch+gap)
-        for note_ndx in range(bottom_border, top_border):
-            neighbours_set.add(note_ndx)
-        return neighbours_set.intersection(tone.get_tone_note_indexes())
+        if top_border <= bottom_border:
+            return 0
+        return ((1 << top_border) - (1 << bottom_border)) & tone.tone_mask
+
+    def get_neighbours(self, tone: Tone, bottom_border=52, top_border=84, gap=12):
+        return pitches_from_mask(self.get_neighbours_mask(tone, bottom_border, top_border, gap))
 
     def get_tone_neighbours(self, tone: Tone, bottom_border=52, top_border=84):
-        neighbours = self.get_neighbours(tone, bottom_border, top_border)
-        harmonic = tone.get_harmonic_note_indexes()
-        return neighbours.intersection(harmonic)
+        return pitches_from_mask(self.get_neighbours_mask(tone, bottom_border, top_border) & tone.harmonic_mask)
 
     def next_note_probability_in_tone(self, tone: Tone):
         last_note = self
@@ -211,56 +367,121 @@ class Note:
             self.pitch -= 1
 
     def __str__(self):
-        note_representations = [
-            "C", "C♯", "D", "E♭", "E", "F", "F♯", "G", "G♯", "A", "B♭", "H"
-        ]
-        representation = self.atomic['representation'] + note_representations[self.get_tone_index()]
-        representation += str((self.pitch // 12) + 1)
-        return representation
+        if 0 <= self.pitch < len(PITCH_NAMES):
+            return self.atomic['representation'] + PITCH_NAMES[self.pitch]
+        return self.atomic['representation'] + NOTE_NAMES[self.get_tone_index()] + str((self.pitch // 12) + 1)
+
+
+class NoteTransitionTable:
+    # next note candidates depend only on the tone and the previous pitch,
+    # so every (tone, pitch) distribution is computed once and reused
+
+    def __init__(self, bottom_border=52, top_border=84, gap=12):
+        self.bottom_border = bottom_border
+        self.top_border = top_border
+        self.gap = gap
+        self._candidates = dict()
+        self._harmonic_candidates = dict()
+        self._non_harmonic_candidates = dict()
+        self._harmonic_samplers = dict()
+        self._non_harmonic_samplers = dict()
+
+    def candidates(self, tone: Tone, pitch: int) -> tuple:
+        key = (tone, pitch)
+        candidates = self._candidates.get(key)
+        if candidates is None:
+            previous_note = Note(0, None)
+            previous_note.pitch = pitch
+            candidates = tuple(previous_note.next_note_probability_in_tone(tone))
+            self._candidates[key] = candidates
+        return candidates
+
+    def harmonic_candidates(self, tone: Tone, pitch: int) -> tuple:
+        key = (tone, pitch)
+        candidates = self._harmonic_candidates.get(key)
+        if candidates is None:
+            previous_note = Note(0, None)
+            previous_note.pitch = pitch
+            allowed_mask = previous_note.get_neighbours_mask(tone, self.bottom_border, self.top_border, self.gap) \
+                & tone.harmonic_mask
+            candidates = tuple(note for note in self.candidates(tone, pitch)
+                               if allowed_mask >> note['note_index'] & 1)
+            self._harmonic_candidates[key] = candidates
+        return candidates
+
+    def non_harmonic_candidates(self, tone: Tone, pitch: int) -> tuple:
+        key = (tone, pitch)
+        candidates = self._non_harmonic_candidates.get(key)
+        if candidates is None:
+            # harmonic sounds without the wrong sounds to differentiate
+            allowed_mask = tone.harmonic_mask & ~tone.forbidden_mask
+            candidates = tuple(note for note in self.candidates(tone, pitch)
+                               if allowed_mask >> note['note_index'] & 1)
+            self._non_harmonic_candidates[key] = candidates
+        return candidates
+
+    def harmonic_sampler(self, tone: Tone, pitch: int):
+        # None when there is no harmonic candidate for that pitch
+        key = (tone, pitch)
+        if key not in self._harmonic_samplers:
+            candidates = self.harmonic_candidates(tone, pitch)
+            self._harmonic_samplers[key] = self._sampler_from_candidates(candidates) if candidates else None
+        return self._harmonic_samplers[key]
+
+    def non_harmonic_sampler(self, tone: Tone, pitch: int) -> ProbabilitySampler:
+        key = (tone, pitch)
+        sampler = self._non_harmonic_samplers.get(key)
+        if sampler is None:
+            sampler = self._sampler_from_candidates(self.non_harmonic_candidates(tone, pitch))
+            self._non_harmonic_samplers[key] = sampler
+        return sampler
+
+    @staticmethod
+    def _sampler_from_candidates(candidates: tuple) -> ProbabilitySampler:
+        return ProbabilitySampler([note['note_index'] for note in candidates],
+                                  [note['probability'] for note in candidates])
+
+
+note_transitions = NoteTransitionTable()
 
 
 class Bar:
+    # notes and tones are keyed by tick offset; the sorted offset lists and the
+    # end-of-bar cursor keep lookups logarithmic whatever the bar resolution
     def __init__(self, size: int):
         self.tones = dict()
         self.notes = dict()
         self.bar_size = size
+        self._tone_offsets = []
+        self._note_offsets = []
+        self._end = 0
 
     def __str__(self):
-        bar_str = "| "
-        for note_index, note in self.notes.items():
-            bar_str += str(note) + " "
+        return "| " + "".join([str(note) + " " for note in self.notes.values()]) \
+            + "/".join([tone.name for tone in self.tones.values()]) + "|"
 
-        bar_str += "/".join([str(x) for x in self.tones.values()])
-        bar_str += "|"
-        return bar_str
+    def set_tone(self, index, tone: Tone):
+        if index not in self.tones:
+            bisect.insort(self._tone_offsets, index)
+        self.tones[index] = tone
 
     def append_note(self, note: Note):
-        space_left = self.get_space_left()
-        if note.length > space_left:
+        if note.length > self.bar_size - self._end:
             raise ValueError("Can not fit that note into bar (incorrect size).")
-        new_ndx = self.bar_size - space_left
-        self.notes[new_ndx] = note
+        self.notes[self._end] = note
+        self._note_offsets.append(self._end)
+        self._end += note.length
 
     def get_space_left(self) -> int:
-        if len(self.notes) == 0:
-            return self.bar_size
-        max_key = max(self.notes.keys())
-        last_note = self.notes[max_key]
-        return self.bar_size - (max_key + last_note.length)
+        return self.bar_size - self._end
 
     def get_tone_for_note_index(self, index) -> Tone:
         if len(self.tones) == 0:
             raise ValueError("There are not any tones in this bar.")
-        if index in self.tones:
-            return self.tones[index]
-        else:
-            curr_tone_ndx = 0
-            curr_tone = self.tones[0]
-            while curr_tone_ndx <= index:
-                if curr_tone_ndx in self.tones:
-                    curr_tone = self.tones[curr_tone_ndx]
-                curr_tone_ndx += 1
-            return curr_tone
+        tone_ndx = bisect.bisect_right(self._tone_offsets, index) - 1
+        if tone_ndx < 0:
+            raise ValueError("There is not any tone before given index.")
+        return self.tones[self._tone_offsets[tone_ndx]]
 
     def get_note_for_index(self, index) -> Note:
         if len(self.notes) == 0:
@@ -269,7 +490,7 @@ class Bar:
             return self.notes[index]
         else:
             # find the first note after given index
-            keys = [k for k in self.notes.keys() if k > index]
-            if len(keys) == 0:
+            note_ndx = bisect.bisect_right(self._note_offsets, index)
+            if note_ndx == len(self._note_offsets):
                 raise ValueError("Note not found in bar.")
-            return self.notes[keys[0]]
+            return self.notes[self._note_offsets[note_ndx]]
@@ -0,0 +1,201 @@
+import io
+import os
+import json
+import hashlib
+import inspect
+
+try:
+    import fcntl
+except ImportError:  # no cross-process stats lock on this platform
+    fcntl = None
+
+import Pipeline
+import Transcription
+
+# modules whose code decides the generated bytes
+CODE_MODULES = ["MusicElements.py", "RepetitiveElements.py", "SeedRandomizer.py", "Processors.py",
+                "MidiWriter.py", "Pipeline.py"]
+# options which do not change the generated bytes
+NEUTRAL_OPTIONS = {'streaming', 'elements_file', 'bar_workers'}
+# transcriptions (JSON form, every section) are stored next to entries, as `<key><suffix>.transcript`
+TRANSCRIPT_SUFFIX = ".transcript"
+
+_code_version = None
+_option_defaults = None
+
+
+def option_defaults() -> dict:
+    # generation options of Pipeline.build_processors with their defaults
+    global _option_defaults
+    if _option_defaults is None:
+        _option_defaults = {name: parameter.default for name, parameter in
+                            inspect.signature(Pipeline.build_processors).parameters.items()
+                            if parameter.default is not inspect.Parameter.empty}
+    return _option_defaults
+
+
+def code_version() -> str:
+    global _code_version
+    if _code_version is None:
+        code_hash = hashlib.sha1()
+        module_dir = os.path.dirname(os.path.abspath(__file__))
+        for module in CODE_MODULES:
+            with open(os.path.join(module_dir, module), "rb") as module_f:
+                code_hash.update(module_f.read())
+        _code_version = code_hash.hexdigest()
+    return _code_version
+
+
+def file_hash(file_name: str) -> str:
+    with open(file_name, "rb") as hashed_f:
+        return hashlib.sha1(hashed_f.read()).hexdigest()
+
+
+class OutputCache:
+    # generated MIDI files stored under a hash of everything that decides their content;
+    # file modification times order entries for LRU eviction, writes are atomic renames
+    def __init__(self, directory: str, max_size: int = 256 * 1024 * 1024, suffix: str = ".mid"):
+        self.directory = directory
+        self.max_size = max_size
+        self.suffix = suffix  # of entry files, e.g. other stores in the same directory keep theirs apart
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, seed: str, options: dict) -> str:
+        # options left at their defaults are left out, a request naming them gets the same key
+        elements_file = options.get('elements_file', Pipeline.ELEMENTS_FILE)
+        defaults = option_defaults()
+        payload = {
+            'seed': seed,
+            'options': {name: value for name, value in options.items()
+                        if name not in NEUTRAL_OPTIONS and (name not in defaults or value != defaults[name])},
+            'elements': file_hash(elements_file),
+            'code': code_version()
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    @staticmethod
+    def _read(path: str):
+        try:
+            with open(path, "rb") as cached_f:
+                content = cached_f.read()
+            os.utime(path)  # most recently used
+        except FileNotFoundError:
+            return None
+        return content
+
+    def _write(self, path: str, content: bytes):
+        temp_file = path + "." + str(os.getpid()) + ".tmp"
+        with open(temp_file, "wb") as cached_f:
+            cached_f.write(content)
+        os.replace(temp_file, path)
+
+    def _count(self, hit: bool):
+        if hit:
+            self.hits += 1
+            self._update_stats(hits=1)
+        else:
+            self.misses += 1
+            self._update_stats(misses=1)
+
+    def get(self, key: str):
+        midi_bytes = self._read(self._path(key))
+        self._count(midi_bytes is not None)
+        return midi_bytes
+
+    def put(self, key: str, midi_bytes: bytes):
+        self._write(self._path(key), midi_bytes)
+        self.evict()
+
+    def entries(self) -> list:
+        entries = []
+        with os.scandir(self.directory) as directory_entries:
+            for entry in directory_entries:
+                if not entry.name.endswith((self.suffix, self.suffix + TRANSCRIPT_SUFFIX)):
+                    continue
+                try:
+                    entry_stat = entry.stat()
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        if total_size <= self.max_size:
+            return
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                evicted += 1
+            except FileNotFoundError:
+                pass
+            total_size -= size
+        self.evictions += evicted
+        self._update_stats(evictions=evicted)
+
+    def _update_stats(self, **increments):
+        # totals shared by every process using this cache directory
+        stats_file = os.path.join(self.directory, "stats.json")
+        with open(stats_file, "a+") as stats_f:
+            if fcntl is not None:
+                fcntl.flock(stats_f, fcntl.LOCK_EX)
+            stats_f.seek(0)
+            content = stats_f.read()
+            stats = json.loads(content) if content else {}
+            for name, value in increments.items():
+                stats[name] = stats.get(name, 0) + value
+            stats_f.seek(0)
+            stats_f.truncate()
+            stats_f.write(json.dumps(stats))
+
+    def stats(self) -> dict:
+        stats_file = os.path.join(self.directory, "stats.json")
+        try:
+            with open(stats_file) as stats_f:
+                stats = json.loads(stats_f.read() or "{}")
+        except FileNotFoundError:
+            stats = {}
+        entries = self.entries()
+        return {
+            'hits': stats.get('hits', 0),
+            'misses': stats.get('misses', 0),
+            'evictions': stats.get('evictions', 0),
+            'entries': len(entries),
+            'size': sum(size for _, size, _ in entries),
+            'max_size': self.max_size
+        }
+
+    def generate(self, seed: str, transcript: Transcription.TranscriptionWriter = None, **options) -> bytes:
+        # cached MIDI bytes, running the pipeline only on a miss; with a `transcript` writer the
+        # stored transcription is written to it (an entry whose transcription was evicted is a miss)
+        key = self.key(seed, options)
+        transcript_path = self._path(key) + TRANSCRIPT_SUFFIX
+        stored = self._read(transcript_path) if transcript is not None else None
+        if transcript is None or stored is not None:
+            midi_bytes = self.get(key)
+        else:
+            midi_bytes = None
+            self._count(False)
+        if midi_bytes is None:
+            recorder = None
+            if transcript is not None:
+                recorder = Transcription.TranscriptionWriter(io.StringIO(), json_format=True)
+            midi_bytes = Pipeline.generate_bytes(seed, transcript=recorder, **options)
+            if recorder is not None:
+                recorder.flush()
+                stored = recorder.stream.getvalue().encode("utf-8")
+                self._write(transcript_path, stored)
+            self.put(key, midi_bytes)
+        if transcript is not None:
+            Transcription.replay_stored(transcript, stored.decode("utf-8"))
+        return midi_bytes
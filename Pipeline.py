@@ -0,0 +1,79 @@
+import io
+import os
+import sys
+import random
+
+import Metrics
+import Processors
+import SeedRandomizer
+
+ELEMENTS_FILE = "rhythmelements.json"
+RANDOM_STAGES = ["tones", "samples", "bars"]
+
+
+def stage_randoms(seed: str, chunked=False) -> dict:
+    # one shared stream keeps melodies of the original generator; chunked generation
+    # gives every stage its own stream, so a stage draws the same numbers however others run
+    if not chunked:
+        shared_random = random.Random(seed)
+        return {stage: shared_random for stage in RANDOM_STAGES}
+    return {stage: random.Random(SeedRandomizer.derive_seed(seed, stage)) for stage in RANDOM_STAGES}
+
+
+def build_processors(results: Processors.ProcessorResults, output_file, bars: int = 32, tones: str = "",
+                     bpm: int = 120, continuous=False, rich=False, elements_file: str = ELEMENTS_FILE,
+                     streaming=False, midi_backend: str = "native", chunk_bars: int = 0, bar_workers: int = 1,
+                     seed: str = None, randoms: dict = None, midi=True, audio_file=None,
+                     sample_rate: int = 44100, dataset_sink=None, transcript=None,
+                     compounding_friends=False) -> list:
+    # without `midi` the pipeline ends with bars, e.g. for a text transcription;
+    # `transcript` is a Transcription.TranscriptionWriter of this generation
+    if streaming and (midi + (audio_file is not None) + (dataset_sink is not None)) > 1:
+        raise ValueError("Streamed bars can be consumed by one output stage only.")
+    if continuous and chunk_bars > 0:
+        raise ValueError("Continuous bars can not be generated in chunks.")
+    randoms = randoms or {stage: random for stage in RANDOM_STAGES}
+    processors = [
+        Processors.ElementsParserProcessor(results, elements_file),
+        Processors.ToneGeneratorProcessor(results, tones, rng=randoms["tones"], transcript=transcript),
+        Processors.SequenceSamplesGeneratorProcessor(results, rng=randoms["samples"], transcript=transcript),
+        Processors.BarSampleGeneratorProcessor(results, bars, streaming, rng=randoms["bars"], chunk_bars=chunk_bars,
+                                               chunk_seed=seed, workers=bar_workers, transcript=transcript,
+                                               compounding_friends=compounding_friends)
+        if not continuous else Processors.BarGeneratorProcessor(results, streaming, rng=randoms["bars"],
+                                                                transcript=transcript)
+    ]
+    if midi:
+        processors.append(Processors.MidiGeneratorProcessor(results, output_file, bpm, rich, midi_backend))
+    if audio_file is not None:
+        # raw 16-bit samples for .raw and .pcm files, WAV otherwise
+        wav = not str(audio_file).lower().endswith((".raw", ".pcm"))
+        processors.append(Processors.AudioGeneratorProcessor(results, audio_file, bpm, rich, sample_rate, wav))
+    if dataset_sink is not None:
+        processors.append(Processors.DatasetExportProcessor(results, seed, dataset_sink))
+    return processors
+
+
+def generate(seed: str, output_file, metrics: Metrics.PipelineMetrics = None, **options) \
+        -> Processors.ProcessorResults:
+    # every generation seeds its own generators, so one process can
+    # produce many melodies in a row with the same output as separate runs
+    randoms = stage_randoms(seed, options.get('chunk_bars', 0) > 0)
+    results = Processors.ProcessorResults()
+    for processor in build_processors(results, output_file, seed=seed, randoms=randoms, **options):
+        if metrics is not None:
+            metrics.measure(processor)
+        else:
+            processor.process()
+    return results
+
+
+def generate_bytes(seed: str, **options) -> bytes:
+    midi_f = io.BytesIO()
+    generate(seed, midi_f, **options)
+    return midi_f.getvalue()
+
+
+def silence_worker():
+    # worker processes generate many melodies, anything they print is just noise
+    sys.stdout = open(os.devnull, "w")
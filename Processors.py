@@ -1,16 +1,26 @@
+import os
 import json
+import array
 import random
 import copy
+import pickle
+import hashlib
 import logging
+import itertools
+import collections
 
-from miditime.miditime import MIDITime
-
+import Metrics
 import SeedRandomizer
-from MusicElements import Tone, ToneType, Note, Bar
-from RepetitiveElements import SequenceSample
+import Transcription
+from MidiWriter import SmfWriter
+from MusicElements import Tone, ToneType, Note, Bar, note_transitions, tone_progressions, all_tones, atomic_id
+from RepetitiveElements import SequenceSample, SampleGraph
 
 
 class ProcessorResults:
+    element_fields = ('elements_source', 'elements_atomic_keys', 'elements_rhythm_sequences',
+                      'elements_rhythm_samplers')
+
     def __init__(self):
         self.elements_source = {}
         self.default_bar_size = 32
@@ -22,20 +32,119 @@ class ProcessorResults:
         self.tone_sequence = []
         self.tone_length_sequence = []
         self.sequence_samples = []
+        self.sample_graph = None
+        self.elements_rhythm_samplers = {}
+
+    def stage_state(self) -> dict:
+        # everything computed by the stages except compiled elements, which
+        # ElementsParserProcessor caches on its own; streamed bars can not be stored
+        return {name: value for name, value in vars(self).items()
+                if name not in ProcessorResults.element_fields
+                and not (name == 'bars' and not isinstance(value, list))}
+
+    def restore_stage_state(self, state: dict):
+        vars(self).update(state)
 
 
 class DefaultProcessor:
-    def __init__(self, results: ProcessorResults):
+    def __init__(self, results: ProcessorResults, rng=random, transcript=None):
         self.results = results
+        # random.Random instance (or the random module) the stage draws from
+        self.rng = rng
+        # Transcription.TranscriptionWriter of the generation, None transcribes nothing
+        self.transcript = transcript
 
     def process(self):
         raise NotImplementedError("Object is a default processor")
 
+    def rhythm_sequence_sampler(self, max_length: int) -> SeedRandomizer.ProbabilitySampler:
+        # rhythm elements that fit into `max_length`, built once per length
+        sampler = self.results.elements_rhythm_samplers.get(max_length)
+        if sampler is None:
+            possible_sequences = [seq for seq in
+                                  self.results.elements_rhythm_sequences if seq['length'] <= max_length]
+            sampler = SeedRandomizer.ProbabilitySampler.from_probability_list(possible_sequences)
+            self.results.elements_rhythm_samplers[max_length] = sampler
+        return sampler
+
+    def bar_notes(self, rich_mode=False, bars=None):
+        # yields (bar end beat, melody notes, accompaniment notes) for each bar (of
+        # results unless `bars` are given), every note as [beat, pitch, velocity, length]
+        bar_bpm = 8
+        bar_time = self.results.default_bar_size / bar_bpm
+
+        curr_beat = 0
+
+        for bar in self.results.bars if bars is None else bars:
+            midi_data = []
+            midi_tone_data = []
+            tone_beat = curr_beat
+            for note_ndx, note in bar.notes.items():
+                note_midi_length = bar_time * (note.length / bar.bar_size)
+                if not note.silent:
+                    midi_data.append([
+                        curr_beat, note.pitch + (12 if rich_mode else 0), 127, note_midi_length
+                    ])
+                curr_beat += note_midi_length
+
+            if not rich_mode:
+                tone_length = self.results.default_bar_size // len(bar.tones.items())
+                for tone_ndx, tone in bar.tones.items():
+                    tone_midi_length = bar_time * (tone_length / bar.bar_size)
+                    midi_tone_data.append([
+                        tone_beat, tone.get_note_index_by_octave(3), 90, tone_midi_length
+                    ])
+                    midi_tone_data.append([
+                        tone_beat, tone.get_note_index_by_octave(4)+7, 90, tone_midi_length
+                    ])
+                    if tone.type == ToneType.Dur:
+                        midi_tone_data.append([
+                            tone_beat, tone.get_note_index_by_octave(4) + 4, 90, tone_midi_length
+                        ])
+                    if tone.type == ToneType.Mol:
+                        midi_tone_data.append([
+                            tone_beat, tone.get_note_index_by_octave(4) + 3, 90, tone_midi_length
+                        ])
+
+                    tone_beat += tone_midi_length
+            else:
+                rich_tone_length = self.results.default_bar_size // 8
+                rich_tone_real_length = bar_time * (rich_tone_length / bar.bar_size)
+                tone_accomp_curr = 0
+                rich_tone_seq_ndx = 0
+                while tone_accomp_curr < bar.bar_size:
+                    rich_tone = bar.get_tone_for_note_index(tone_accomp_curr)
+                    rich_tone_seq = [
+                        rich_tone.get_note_index_by_octave(3),
+                        rich_tone.get_note_index_by_octave(4),
+                        rich_tone.get_note_index_by_octave(4) + 4
+                        if rich_tone.type == ToneType.Dur else
+                        rich_tone.get_note_index_by_octave(4) + 3,
+                        rich_tone.get_note_index_by_octave(4)+7,
+
+                    ]
+                    midi_tone_data.append([
+                        tone_beat, rich_tone_seq[rich_tone_seq_ndx], 90,
+                        rich_tone_real_length*(len(rich_tone_seq)-rich_tone_seq_ndx)
+                    ])
+                    rich_tone_seq_ndx = 0 if rich_tone_seq_ndx >= len(rich_tone_seq) - 1 else rich_tone_seq_ndx + 1
+                    tone_beat += rich_tone_real_length
+                    tone_accomp_curr += rich_tone_length
+
+            yield curr_beat, midi_data, midi_tone_data
+
 
 class ElementsParserProcessor(DefaultProcessor):
-    def __init__(self, results: ProcessorResults, json_file: str):
+    # compiled elements are cached on disk (and per process) under the hash of
+    # the JSON content; bump the version when the compiled layout changes
+    cache_version = 1
+    compiled_elements = dict()
+
+    def __init__(self, results: ProcessorResults, json_file: str, cache_file: str = None):
         super().__init__(results)
         self.json_source = json_file
+        # an empty string disables the on-disk cache
+        self.cache_file = json_file + ".cache" if cache_file is None else cache_file
 
     @staticmethod
     def notes_from_element(element: str, atomic: dict):
@@ -52,13 +161,8 @@ class ElementsParserProcessor(DefaultProcessor):
             notes.append(cur_note)
         return notes
 
-    def process(self):
-        elements_f = open(self.json_source)
-        elements = json.loads(elements_f.read())
-        self.results.elements_source = elements
-
-        self.results.default_bar_size = elements['bar']['size']
-        self.results.elements_atomic_keys = list(elements['atomic'].keys())
+    def compile_elements(self, source: bytes) -> dict:
+        elements = json.loads(source.decode("utf-8"))
 
         # generate note sequences from elements
         rhythm_elements = elements['elements']
@@ -68,71 +172,149 @@ class ElementsParserProcessor(DefaultProcessor):
             for note in re['notes']:
                 seq_length += note.length
             re['length'] = seq_length
+        return elements
+
+    @staticmethod
+    def pack_elements(elements: dict) -> dict:
+        # template notes become codes: atomic key index * 4 + harmonic * 2 + silent
+        atomic_keys = {atomic_id(atomic): ndx for ndx, atomic in enumerate(elements['atomic'].values())}
+        packed = dict(elements)
+        packed['elements'] = []
+        for re in elements['elements']:
+            packed_re = {key: value for key, value in re.items() if key != 'notes'}
+            packed_re['notes'] = array.array("H", [
+                atomic_keys[note.atomic_id] * 4 + note.harmonic_flag * 2 + note.silent for note in re['notes']
+            ])
+            packed['elements'].append(packed_re)
+        return packed
+
+    @staticmethod
+    def unpack_elements(packed: dict) -> dict:
+        # template notes are never modified (only their copies are), so equal notes are shared
+        atomics = list(packed['atomic'].values())
+        templates = dict()
+        for re in packed['elements']:
+            notes = []
+            for code in re['notes']:
+                note = templates.get(code)
+                if note is None:
+                    note_atomic = atomics[code // 4]
+                    note = Note(note_atomic['length'], note_atomic)
+                    note.harmonic_flag = bool(code & 2)
+                    note.silent = bool(code & 1)
+                    templates[code] = note
+                notes.append(note)
+            re['notes'] = notes
+        return packed
+
+    def load_cache(self, content_hash: str):
+        if not self.cache_file:
+            return None
+        try:
+            with open(self.cache_file, "rb") as cache_f:
+                cached = pickle.load(cache_f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+        if not isinstance(cached, dict) or cached.get('version') != self.cache_version \
+                or cached.get('hash') != content_hash:
+            return None
+        return self.unpack_elements(cached['elements'])
+
+    def save_cache(self, content_hash: str, elements: dict):
+        if not self.cache_file:
+            return
+        temp_file = self.cache_file + "." + str(os.getpid()) + ".tmp"
+        try:
+            with open(temp_file, "wb") as cache_f:
+                pickle.dump({
+                    'version': self.cache_version,
+                    'hash': content_hash,
+                    'elements': self.pack_elements(elements)
+                }, cache_f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, self.cache_file)
+        except OSError:
+            logging.warning("Can not write elements cache " + self.cache_file)
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
 
-        self.results.elements_rhythm_sequences = rhythm_elements
+    def process(self):
+        with open(self.json_source, "rb") as elements_f:
+            source = elements_f.read()
+        content_hash = hashlib.sha1(source).hexdigest()
+
+        elements = self.compiled_elements.get(content_hash)
+        if elements is None:
+            elements = self.load_cache(content_hash)
+            if elements is None:
+                elements = self.compile_elements(source)
+                self.save_cache(content_hash, elements)
+            self.compiled_elements[content_hash] = elements
+
+        self.results.elements_source = elements
+        self.results.default_bar_size = elements['bar']['size']
+        self.results.elements_atomic_keys = list(elements['atomic'].keys())
+        self.results.elements_rhythm_sequences = elements['elements']
+        self.results.elements_rhythm_samplers = {}
 
 
 class ToneGeneratorProcessor(DefaultProcessor):
 
-    def __init__(self, results: ProcessorResults, tones: str = ""):
-        super().__init__(results)
+    def __init__(self, results: ProcessorResults, tones: str = "", rng=random, transcript=None):
+        super().__init__(results, rng, transcript)
         self.given_tones = []
         if tones != "":
             self.given_tones = tones.split(",")
 
-    def process(self):
-        # generate all tones
-        tones = set()
-        for t_ndx in range(0, 12):
-            newtone = Tone(t_ndx, ToneType.Dur)
-            moltone = Tone(t_ndx, ToneType.Mol)
-            tones.add(newtone)
-            tones.add(moltone)
+    @staticmethod
+    def parse_tone(tone_str: str) -> tuple:
+        # (tone, length in bars) of a tone given like `C`, `Hbm` or `.Fs` (a half bar tone)
+        seek_ndx = 0
+        half_tone = False
+        if tone_str[seek_ndx] == ".":
+            seek_ndx += 1
+            half_tone = True
+
+        tone_map = {
+            'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'H': 11, 'B': 10
+        }
+
+        tone_chr = tone_str[seek_ndx]
+        seek_ndx += 1
+        tone_lvl = tone_map[tone_chr]
+        tone_mol = False
+        while seek_ndx < len(tone_str):
+            if tone_str[seek_ndx] == 'b':
+                tone_lvl -= 1
+            if tone_str[seek_ndx] == 's':
+                tone_lvl += 1
+            if tone_str[seek_ndx] == 'm':
+                tone_mol = True
+            seek_ndx += 1
+
+        tone_lvl %= 12
+        tone = Tone(tone_lvl, ToneType.Mol if tone_mol else ToneType.Dur)
+        return tone, 0.5 if half_tone else 1.0
 
+    def process(self):
+        # collect all tones (Tone instances are interned singletons)
+        tones = all_tones()
         self.results.singleton_tones = tones
 
         if len(self.given_tones) > 0:
             tone_sequence = []
             tone_length_sequence = []
             for tone_str in self.given_tones:
-                seek_ndx = 0
-                half_tone = False
-                if tone_str[seek_ndx] == ".":
-                    seek_ndx += 1
-                    half_tone = True
-
-                tone_map = {
-                    'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'H': 11, 'B': 10
-                }
-
-                tone_chr = tone_str[seek_ndx]
-                seek_ndx += 1
-                tone_lvl = tone_map[tone_chr]
-                tone_mol = False
-                while seek_ndx < len(tone_str):
-                    if tone_str[seek_ndx] == 'b':
-                        tone_lvl -= 1
-                    if tone_str[seek_ndx] == 's':
-                        tone_lvl += 1
-                    if tone_str[seek_ndx] == 'm':
-                        tone_mol = True
-                    seek_ndx += 1
-
-                tone_lvl %= 12
-                if not tone_mol:
-                    tone_sequence.append(Tone(tone_lvl, ToneType.Dur))
-                else:
-                    tone_sequence.append(Tone(tone_lvl, ToneType.Mol))
-
-                tone_length_sequence.append(0.5 if half_tone else 1.0)
+                tone, tone_length = self.parse_tone(tone_str)
+                tone_sequence.append(tone)
+                tone_length_sequence.append(tone_length)
             self.results.primary_tone = tone_sequence[0]
         else:
-            primary_tone = SeedRandomizer.random_from_sorted_set(tones)
+            primary_tone = SeedRandomizer.random_from_sorted_set(tones, self.rng)
             self.results.primary_tone = primary_tone
             logging.info("Primary tone: " + str(primary_tone))
 
             # `sadness` probability
-            mol_chance = 0.15 + random.random() * 0.6
+            mol_chance = 0.15 + self.rng.random() * 0.6
 
             logging.info("Sadness probability: " + str(mol_chance))
 
@@ -140,11 +322,10 @@ class ToneGeneratorProcessor(DefaultProcessor):
 
             last_tone = primary_tone
 
-            for i in range(0, 3+ random.randrange(0, 5)):
-                tone_probabilities = last_tone.next_tone_probability_list(self.results.singleton_tones)
-                tone_choosen = SeedRandomizer.random_from_probability_list(tone_probabilities)
-                tone_sequence.append(tone_choosen["tone"])
-                last_tone = tone_choosen["tone"]
+            for i in range(0, 3+ self.rng.randrange(0, 5)):
+                tone_choosen = tone_progressions.sampler(last_tone).draw(self.rng)
+                tone_sequence.append(tone_choosen)
+                last_tone = tone_choosen
 
             tone_length_sequence = []
             seqence_sum = 0.0
@@ -158,24 +339,24 @@ class ToneGeneratorProcessor(DefaultProcessor):
                         and (i == 1 or tone_length_sequence[i-2] == 1):
                     tone_length_sequence.append(0.5)
                 else:
-                    tone_length_sequence.append(0.5 if random.random() > 0.33 else 1.0)
+                    tone_length_sequence.append(0.5 if self.rng.random() > 0.33 else 1.0)
                 seqence_sum += tone_length_sequence[i]
 
         logging.info("Tone sequence:")
-        for ndx, tone in enumerate(tone_sequence):
-            print(str(tone_length_sequence[ndx]) + str(tone) + " ", end='')
-        print("")
+        transcript = Transcription.writer_for(self.transcript, "tones")
+        if transcript is not None:
+            transcript.tone_sequence(tone_sequence, tone_length_sequence)
         self.results.tone_sequence = tone_sequence
         self.results.tone_length_sequence = tone_length_sequence
 
 
 class SequenceSamplesGeneratorProcessor(DefaultProcessor):
-    def __init__(self, results: ProcessorResults, max_sample_count=10):
+    def __init__(self, results: ProcessorResults, max_sample_count=10, rng=random, transcript=None):
         self.max_sample_count = max_sample_count
-        super(SequenceSamplesGeneratorProcessor, self).__init__(results)
+        super(SequenceSamplesGeneratorProcessor, self).__init__(results, rng, transcript)
 
     def process(self):
-        sample_types = [
+        sample_types = SeedRandomizer.ProbabilitySampler.from_probability_list([
             {
                 'length': self.results.default_bar_size // 2,
                 'probability': 0.8
@@ -184,21 +365,20 @@ class SequenceSamplesGeneratorProcessor(DefaultProcessor):
                 'length': self.results.default_bar_size,
                 'probability': 0.2
             }
-        ]
-        sample_count = random.randrange(6, self.max_sample_count)
+        ])
+        sample_count = self.rng.randrange(6, self.max_sample_count)
         self.results.sequence_samples = []
         first_sample_flag = True
         logging.info("Samples:")
+        transcript = Transcription.writer_for(self.transcript, "samples")
         for sample_ndx in range(0, sample_count):
-            sample_type = SeedRandomizer.random_from_probability_list(sample_types)
+            sample_type = sample_types.draw(self.rng)
             sample_length_rest = sample_type['length']
             sample_notes = []
 
             # generate sample notes
             while sample_length_rest > 0:
-                possible_sequences = [seq for seq in
-                                      self.results.elements_rhythm_sequences if seq['length'] <= sample_length_rest]
-                selected_seq = SeedRandomizer.random_from_probability_list(possible_sequences)
+                selected_seq = self.rhythm_sequence_sampler(sample_length_rest).draw(self.rng)
 
                 for seq_note in selected_seq['notes']:
                     sample_notes.append(copy.copy(seq_note))
@@ -217,127 +397,196 @@ class SequenceSamplesGeneratorProcessor(DefaultProcessor):
                     note.finalized = True
                     continue
                 elif note.harmonic_flag:  # harmonic notes
-                    harmonic_range = note_tone.get_harmonic_note_indexes()
-                    note_neighbours = previous_note.get_neighbours(note_tone, top_border=84, gap=12)
-                    tone_range = note_tone.get_harmonic_note_indexes()
-
-                    probability_list = previous_note.next_note_probability_in_tone(note_tone)
-                    probability_list = [note for note in probability_list
-                                        if note['note_index'] in harmonic_range
-                                        and note['note_index'] in note_neighbours
-                                        and note['note_index'] in tone_range]
-                    if len(probability_list) == 0:
+                    pitch_sampler = note_transitions.harmonic_sampler(note_tone, previous_note.pitch)
+                    if pitch_sampler is None:
                         # set the primary note of note tone
                         note.pitch = note_tone.get_note_index_by_octave(5)
                     else:
-                        note.pitch = SeedRandomizer.random_from_probability_list(probability_list)['note_index']
+                        note.pitch = pitch_sampler.draw(self.rng)
 
                 else:  # non-harmonic notes
-                    forbidden_set = note_tone.get_forbidden_note_indexes()  # wrong sounds to differentiate
-                    tone_range = note_tone.get_harmonic_note_indexes()
-
-                    probability_list = previous_note.next_note_probability_in_tone(note_tone)
-                    probability_list = [note for note in probability_list
-                                        if not note['note_index'] in forbidden_set
-                                        and note['note_index'] in tone_range]
+                    pitch_sampler = note_transitions.non_harmonic_sampler(note_tone, previous_note.pitch)
 
-                    note.pitch = SeedRandomizer.random_from_probability_list(probability_list)['note_index']
+                    note.pitch = pitch_sampler.draw(self.rng)
 
                 note.finalized = True
                 previous_note = note
 
             sample = SequenceSample(self.results.primary_tone, sample_notes)
             self.results.sequence_samples.append(sample)
-            logging.info(str(sample))
+            if transcript is not None:
+                transcript.sample(sample)
 
         # now generate `friend` connections between samples
-        sample_connections = random.randrange(2, sample_count // 2)
+        sample_connections = self.rng.randrange(2, sample_count // 2)
         for sample_ndx, sample in enumerate(self.results.sequence_samples):
             shuffled = copy.copy(self.results.sequence_samples)
-            random.shuffle(shuffled)
+            self.rng.shuffle(shuffled)
             sample_poll = [smp for smp in shuffled if smp is not sample]
             conn_count = 0
             for sample_friend in sample_poll:
                 sample.friendly_samples.append({
                     'sample': sample_friend,
-                    'probability': random.random()
+                    'probability': self.rng.random()
                 })
                 conn_count += 1
                 if conn_count >= sample_connections:
                     break
             sample.friendly_samples.append({
                 'sample': sample,
-                'probability': 0.4 * random.random()
+                'probability': 0.4 * self.rng.random()
             })
 
+        self.results.sample_graph = SampleGraph(self.results.sequence_samples)
+
+
+def _generate_bar_chunk(state: ProcessorResults, chunk: tuple, chunk_seed, chunk_bars: int) -> list:
+    # runs in a worker process, `state` holds only what bar generation reads
+    processor = BarSampleGeneratorProcessor(state, None, chunk_bars=chunk_bars, chunk_seed=chunk_seed)
+    return list(processor.generate_chunk(*chunk, processor.chunk_random(chunk[0] // chunk_bars)))
+
 
 class BarSampleGeneratorProcessor(DefaultProcessor):
-    def __init__(self, results: ProcessorResults, min_bar_count: int):
-        super(BarSampleGeneratorProcessor, self).__init__(results)
-        self.min_bar_count = min_bar_count
+    def __init__(self, results: ProcessorResults, min_bar_count, streaming=False, rng=random,
+                 chunk_bars=0, chunk_seed=None, workers=1, transcript=None, compounding_friends=False):
+        super(BarSampleGeneratorProcessor, self).__init__(results, rng, transcript)
+        if compounding_friends and chunk_bars > 0:
+            raise ValueError("Compounding friend weights depend on every bar before, they can not be chunked.")
+        self.min_bar_count = min_bar_count  # None generates an unbounded stream of bars
+        self.streaming = streaming
+        # with `chunk_bars` every chunk of bars draws from its own stream derived from
+        # `chunk_seed`, so chunks are independent and `workers` processes can generate them
+        self.chunk_bars = chunk_bars
+        self.chunk_seed = chunk_seed
+        self.workers = workers
+        # choose friends like generators before SampleGraph, whose melodies older seeds give
+        self.compounding_friends = compounding_friends
 
     def process(self):
-        bars = list()
-        first_sequence_in_all_bars = True
-        previous_sequence: SequenceSample
+        bars = self.generate_bars()
+        self.results.bars = bars if self.streaming else list(bars)
+
+    def generate_bars(self):
+        logging.info("Bars:")
+        if self.chunk_bars > 0:
+            bars = self.generate_chunked_bars()
+        else:
+            bars = self.generate_chunk(0, self.min_bar_count, 0, 0, self.rng)
+        transcript = Transcription.writer_for(self.transcript, "bars")
+        for bar in bars:
+            if transcript is not None:
+                transcript.bar(bar)
+            yield bar
+
+        logging.debug("Transposition cache: " + str(sum(seq.transposition_hits for seq in self.results.sequence_samples))
+                      + " hits, " + str(sum(seq.transposition_misses for seq in self.results.sequence_samples))
+                      + " misses")
+
+    def chunk_random(self, chunk_ndx: int) -> random.Random:
+        return random.Random(SeedRandomizer.derive_seed(self.chunk_seed, "bars", chunk_ndx))
+
+    def chunks(self):
+        # (first bar, bar count, tone index, tone length index) of every chunk;
+        # tone cursors do not depend on random draws, so they are just replayed
         tone_sequence_ndx = 0
         tone_length_seqence_ndx = 0
-        logging.info("Bars:")
-        for bar_ndx in range(0, self.min_bar_count):
-            bar = Bar(self.results.default_bar_size)
-
-            # always start with a primary tone
+        bar_ndx = 0
+        while self.min_bar_count is None or bar_ndx < self.min_bar_count:
+            bar_count = self.chunk_bars if self.min_bar_count is None \
+                else min(self.chunk_bars, self.min_bar_count - bar_ndx)
+            yield bar_ndx, bar_count, tone_sequence_ndx, tone_length_seqence_ndx
+            for _ in range(0, bar_count):
+                tone_sequence_ndx, tone_length_seqence_ndx = \
+                    self.place_tones(None, bar_ndx, tone_sequence_ndx, tone_length_seqence_ndx)
+                bar_ndx += 1
+
+    def chunk_state(self) -> ProcessorResults:
+        state = ProcessorResults()
+        state.default_bar_size = self.results.default_bar_size
+        state.primary_tone = self.results.primary_tone
+        state.tone_sequence = self.results.tone_sequence
+        state.tone_length_sequence = self.results.tone_length_sequence
+        state.sequence_samples = self.results.sequence_samples
+        state.sample_graph = self.results.sample_graph
+        return state
+
+    def generate_chunked_bars(self):
+        if self.workers <= 1:
+            for chunk in self.chunks():
+                yield from self.generate_chunk(*chunk, self.chunk_random(chunk[0] // self.chunk_bars))
+            return
+
+        from concurrent.futures import ProcessPoolExecutor  # imported only when chunks run in processes
+
+        state = self.chunk_state()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            # a bounded window of chunks in flight keeps unbounded streams in flat memory
+            pending = collections.deque()
+            for chunk in self.chunks():
+                pending.append(executor.submit(_generate_bar_chunk, state, chunk, self.chunk_seed, self.chunk_bars))
+                if len(pending) >= 2 * self.workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def place_tones(self, bar, bar_ndx: int, tone_sequence_ndx: int, tone_length_seqence_ndx: int) -> tuple:
+        # sets tones of the bar (when given) and returns the tone cursors of the next bar
+        # always start with a primary tone
+        if bar is not None:
             if bar_ndx == 0:
-                bar.tones[0] = self.results.primary_tone
+                bar.set_tone(0, self.results.primary_tone)
             else:
-                bar.tones[0] = self.results.tone_sequence[tone_sequence_ndx]
+                bar.set_tone(0, self.results.tone_sequence[tone_sequence_ndx])
 
+        tone_sequence_ndx = 0 if tone_sequence_ndx >= len(self.results.tone_sequence) - 1 \
+            else tone_sequence_ndx + 1
+
+        if self.results.tone_length_sequence[tone_length_seqence_ndx] == 0.5:
+            if bar is not None:
+                bar.set_tone(bar.bar_size / 2, self.results.tone_sequence[tone_sequence_ndx])
             tone_sequence_ndx = 0 if tone_sequence_ndx >= len(self.results.tone_sequence) - 1 \
                 else tone_sequence_ndx + 1
-
-            if self.results.tone_length_sequence[tone_length_seqence_ndx] == 0.5:
-                bar.tones[bar.bar_size / 2] = self.results.tone_sequence[tone_sequence_ndx]
-                tone_sequence_ndx = 0 if tone_sequence_ndx >= len(self.results.tone_sequence) - 1 \
-                    else tone_sequence_ndx + 1
-                tone_length_seqence_ndx = 0 if tone_length_seqence_ndx >= len(self.results.tone_length_sequence) - 1 \
-                    else tone_length_seqence_ndx + 1
-
             tone_length_seqence_ndx = 0 if tone_length_seqence_ndx >= len(self.results.tone_length_sequence) - 1 \
                 else tone_length_seqence_ndx + 1
 
+        tone_length_seqence_ndx = 0 if tone_length_seqence_ndx >= len(self.results.tone_length_sequence) - 1 \
+            else tone_length_seqence_ndx + 1
+        return tone_sequence_ndx, tone_length_seqence_ndx
+
+    def generate_chunk(self, first_bar: int, bar_count, tone_sequence_ndx: int, tone_length_seqence_ndx: int, rng):
+        previous_sequence = None
+        bar_indexes = itertools.count(first_bar) if bar_count is None else range(first_bar, first_bar + bar_count)
+        for bar_ndx in bar_indexes:
+            bar = Bar(self.results.default_bar_size)
+            tone_sequence_ndx, tone_length_seqence_ndx = \
+                self.place_tones(bar, bar_ndx, tone_sequence_ndx, tone_length_seqence_ndx)
+
             bar_rest = self.results.default_bar_size
             max_sequence_length = bar.bar_size // len(bar.tones)
             while bar_rest > 0:
                 current_tone = bar.get_tone_for_note_index(bar.bar_size - bar_rest)
-                if first_sequence_in_all_bars:  # if first bar get first sequence (with a primary note)
+                max_length = min(bar_rest, max_sequence_length)
+                if previous_sequence is None and bar_ndx == 0:
+                    # if first bar get first sequence (with a primary note)
                     sequence = self.results.sequence_samples[0]
-                    first_sequence_in_all_bars = False
+                elif previous_sequence is None:  # a chunk start, there is no sequence to follow
+                    sequence = rng.choice(self.results.sample_graph.samples_fitting(max_length))
+                elif self.compounding_friends:
+                    sequence_sampler = self.compounding_sampler(previous_sequence, current_tone, max_length)
+                    if sequence_sampler is not None:
+                        sequence = sequence_sampler.draw(rng)['sample']
+                    else:
+                        Metrics.counters['random_choice_fallbacks'] += 1
+                        sequence = rng.choice(self.results.sample_graph.samples_fitting(max_length))
                 else:
-                    # get every possible sequence
-                    sequence_poll = \
-                        [seq for seq in previous_sequence.friendly_samples
-                         if seq['sample'].get_length() <= max_sequence_length
-                            and seq['sample'].get_length() <= bar_rest]
-                    if len(sequence_poll) > 0:
-                        last_note: Note = previous_sequence.get_last_note()
-                        next_probabilities = last_note.next_note_probability_in_tone(current_tone)
-
-                        for seq in sequence_poll:
-                            next_note: Note = seq['sample'].get_first_note()
-                            found_flag = False
-                            for prob_note in next_probabilities:
-                                if next_note.pitch == prob_note['note_index']:
-                                    seq['probability'] *= prob_note['probability']
-                                    found_flag = True
-                                    break
-                            if not found_flag:  # if it's `strange` range jump make it almost impossible
-                                seq['probability'] = 0.01
-
-                        sequence_shot = SeedRandomizer.random_from_probability_list(sequence_poll)
-                        sequence = sequence_shot['sample']
+                    # pick one of friendly sequences which fit into the bar
+                    sequence_sampler = self.results.sample_graph.next_sampler(previous_sequence, current_tone,
+                                                                               max_length)
+                    if sequence_sampler is not None:
+                        sequence = sequence_sampler.draw(rng)
                     else:  # quite impossible-like
-                        sequence = random.choice([seq for seq in self.results.sequence_samples
-                                                  if seq.get_length() <= min(bar_rest, max_sequence_length)])
+                        Metrics.counters['random_choice_fallbacks'] += 1
+                        sequence = rng.choice(self.results.sample_graph.samples_fitting(max_length))
 
                 sequence_transponed_notes = sequence.get_transposed_notes(current_tone)
                 for note in sequence_transponed_notes:
@@ -346,40 +595,59 @@ class BarSampleGeneratorProcessor(DefaultProcessor):
                 previous_sequence = sequence
                 bar_rest = bar.get_space_left()
 
-            bars.append(bar)
-            logging.info(str(bar))
-            self.results.bars = bars
+            yield bar
+
+    @staticmethod
+    def compounding_sampler(previous_sequence: SequenceSample, current_tone: Tone, max_length):
+        # friend weights multiplied in place by the melodic transition probability on every
+        # choice (0.01 for a `strange` range jump), so they compound across bars
+        sequence_poll = [friend for friend in previous_sequence.friendly_samples
+                         if friend['sample'].get_length() <= max_length]
+        if len(sequence_poll) == 0:
+            return None
+        next_probabilities = dict()
+        for prob_note in note_transitions.candidates(current_tone, previous_sequence.get_last_note().pitch):
+            next_probabilities.setdefault(prob_note['note_index'], prob_note['probability'])
+        for friend in sequence_poll:
+            next_probability = next_probabilities.get(friend['sample'].get_first_note().pitch)
+            friend['probability'] = 0.01 if next_probability is None else friend['probability'] * next_probability
+        return SeedRandomizer.ProbabilitySampler.from_probability_list(sequence_poll)
 
 
 class BarGeneratorProcessor(DefaultProcessor):
+    def __init__(self, results: ProcessorResults, streaming=False, rng=random, transcript=None):
+        super(BarGeneratorProcessor, self).__init__(results, rng, transcript)
+        self.streaming = streaming
+
     def process(self):
-        bars = list()
+        bars = self.generate_bars()
+        self.results.bars = bars if self.streaming else list(bars)
 
+    def generate_bars(self):
         tone_sequence_ndx = 0
         # generate bars
         first_note_in_all_bars = True
         previous_note: Note
         logging.info("Bars")
+        transcript = Transcription.writer_for(self.transcript, "bars")
         for bar_gen_ndx in range(0, 64):
             bar = Bar(self.results.default_bar_size)
             # in each bar generate tones
             if bar_gen_ndx == 0:
-                bar.tones[0] = self.results.primary_tone
+                bar.set_tone(0, self.results.primary_tone)
             else:
-                bar.tones[0] = self.results.tone_sequence[tone_sequence_ndx]
+                bar.set_tone(0, self.results.tone_sequence[tone_sequence_ndx])
                 tone_sequence_ndx = 0 if tone_sequence_ndx >= len(self.results.tone_sequence) - 1 \
                     else tone_sequence_ndx + 1
 
-            if random.random() > 0.5:
-                bar.tones[bar.bar_size / 2] = self.results.tone_sequence[tone_sequence_ndx]
+            if self.rng.random() > 0.5:
+                bar.set_tone(bar.bar_size / 2, self.results.tone_sequence[tone_sequence_ndx])
                 tone_sequence_ndx = 0 if tone_sequence_ndx >= len(self.results.tone_sequence) - 1 \
                     else tone_sequence_ndx + 1
 
             bar_rest = bar.bar_size
             while bar_rest > 0:
-                possible_sequences = \
-                    [seq for seq in self.results.elements_rhythm_sequences if seq['length'] <= bar_rest]
-                selected_seq = SeedRandomizer.random_from_probability_list(possible_sequences)
+                selected_seq = self.rhythm_sequence_sampler(bar_rest).draw(self.rng)
 
                 for seq_note in selected_seq['notes']:
                     bar.append_note(copy.copy(seq_note))
@@ -397,116 +665,146 @@ class BarGeneratorProcessor(DefaultProcessor):
                     continue
                 elif note.harmonic_flag:  # harmonic notes
                     note_tone = bar.get_tone_for_note_index(note_ndx)
-                    harmonic_range = note_tone.get_harmonic_note_indexes()
-                    note_neighbours = previous_note.get_neighbours(note_tone, top_border=84, gap=12)
-                    tone_range = note_tone.get_harmonic_note_indexes()
-
-                    probability_list = previous_note.next_note_probability_in_tone(note_tone)
-                    probability_list = [note for note in probability_list
-                                        if note['note_index'] in harmonic_range
-                                        and note['note_index'] in note_neighbours
-                                        and note['note_index'] in tone_range]
-                    if len(probability_list) == 0:
+                    pitch_sampler = note_transitions.harmonic_sampler(note_tone, previous_note.pitch)
+                    if pitch_sampler is None:
                         # set the primary note of note tone
                         note.pitch = note_tone.get_note_index_by_octave(5)
                     else:
-                        note.pitch = SeedRandomizer.random_from_probability_list(probability_list)['note_index']
+                        note.pitch = pitch_sampler.draw(self.rng)
 
                 else:  # non-harmonic notes
                     note_tone = bar.get_tone_for_note_index(note_ndx)  # current tone
-                    forbidden_set = note_tone.get_forbidden_note_indexes()  # wrong sounds to differentiate
-                    tone_range = note_tone.get_harmonic_note_indexes()
-
-                    probability_list = previous_note.next_note_probability_in_tone(note_tone)
-                    probability_list = [note for note in probability_list
-                                        if not note['note_index'] in forbidden_set
-                                        and note['note_index'] in tone_range]
+                    pitch_sampler = note_transitions.non_harmonic_sampler(note_tone, previous_note.pitch)
 
-                    note.pitch = SeedRandomizer.random_from_probability_list(probability_list)['note_index']
+                    note.pitch = pitch_sampler.draw(self.rng)
 
                 note.finalized = True
                 previous_note = note
 
-            logging.info(str(bar))
-            bars.append(bar)
-        self.results.bars = bars
+            if transcript is not None:
+                transcript.bar(bar)
+            yield bar
 
 
 class MidiGeneratorProcessor(DefaultProcessor):
-    def __init__(self, results: ProcessorResults, midi_file: str, bpm: int, rich_mode=False):
-        self.output_file: str = str(midi_file)
+    def __init__(self, results: ProcessorResults, midi_file, bpm: int, rich_mode=False, backend="native"):
+        # `midi_file` is a file name or a binary file-like object (native backend only)
+        self.output_file = midi_file if hasattr(midi_file, "write") else str(midi_file)
         self.bpm = bpm
         self.rich_mode = rich_mode
+        self.backend = backend
         super(MidiGeneratorProcessor, self).__init__(results)
 
     def process(self):
         logging.info("Generating MIDI...")
-        bpm = self.bpm
-        bar_bpm = 8
-        bar_time = self.results.default_bar_size / bar_bpm
+        if self.backend == "miditime":
+            self.process_miditime()
+        elif self.backend == "native":
+            self.process_native()
+        else:
+            raise ValueError("Unknown MIDI backend: " + str(self.backend))
 
-        midi = MIDITime(bpm, self.output_file)
+    def process_native(self):
+        if hasattr(self.output_file, "write"):
+            self.write_native(self.output_file)
+        else:
+            with open(self.output_file, "wb") as midi_f:
+                self.write_native(midi_f)
+
+    def native_writer(self, stream) -> SmfWriter:
+        midi = SmfWriter(stream)
+        for channel in (0, 1):
+            midi.add_program_change(0, channel, 0)
+        midi.add_tempo(0, self.bpm)
+        return midi
+
+    @staticmethod
+    def write_bar(midi: SmfWriter, bar_end_beat: float, melody_notes: list, tone_notes: list):
+        for channel, notes in ((0, melody_notes), (1, tone_notes)):
+            for beat, pitch, velocity, length in notes:
+                midi.add_note(midi.beat_to_tick(beat), channel, pitch, velocity, midi.beat_to_tick(length))
+        # following bars start no earlier than the end of this one
+        midi.flush(midi.beat_to_tick(bar_end_beat))
+
+    def write_native(self, stream):
+        midi = self.native_writer(stream)
+        try:
+            for bar_end_beat, melody_notes, tone_notes in self.bar_notes(self.rich_mode):
+                self.write_bar(midi, bar_end_beat, melody_notes, tone_notes)
+        finally:
+            # an interrupted endless run still leaves a complete file
+            midi.close()
+
+    def process_miditime(self):
+        try:
+            # miditime is optional and slow to import, MIDI files are written by SmfWriter by default
+            from miditime.miditime import MIDITime
+        except ImportError:
+            raise ValueError("The miditime backend requires the miditime library.")
+        if hasattr(self.output_file, "write"):
+            raise ValueError("The miditime backend writes to file names only.")
+        midi = MIDITime(self.bpm, self.output_file)
         midi_data = []
         midi_tone_data = []
+        for bar_end_beat, melody_notes, tone_notes in self.bar_notes(self.rich_mode):
+            midi_data.extend(melody_notes)
+            midi_tone_data.extend(tone_notes)
 
-        curr_beat = 0
+        midi.add_track(midi_data)
+        midi.add_track(midi_tone_data)
+        midi.save_midi()
 
-        for bar in self.results.bars:
-            tone_beat = curr_beat
-            for note_ndx, note in bar.notes.items():
-                note_midi_length = bar_time * (note.length / bar.bar_size)
-                if not note.silent:
-                    midi_data.append([
-                        curr_beat, note.pitch + (12 if self.rich_mode else 0), 127, note_midi_length
-                    ])
-                curr_beat += note_midi_length
 
-            if not self.rich_mode:
-                tone_length = self.results.default_bar_size // len(bar.tones.items())
-                for tone_ndx, tone in bar.tones.items():
-                    tone_midi_length = bar_time * (tone_length / bar.bar_size)
-                    midi_tone_data.append([
-                        tone_beat, tone.get_note_index_by_octave(3), 90, tone_midi_length
-                    ])
-                    midi_tone_data.append([
-                        tone_beat, tone.get_note_index_by_octave(4)+7, 90, tone_midi_length
-                    ])
-                    if tone.type == ToneType.Dur:
-                        midi_tone_data.append([
-                            tone_beat, tone.get_note_index_by_octave(4) + 4, 90, tone_midi_length
-                        ])
-                    if tone.type == ToneType.Mol:
-                        midi_tone_data.append([
-                            tone_beat, tone.get_note_index_by_octave(4) + 3, 90, tone_midi_length
-                        ])
+class AudioGeneratorProcessor(DefaultProcessor):
+    # renders the melody and the accompaniment to 16-bit PCM (WAV or raw samples) bar by bar
+    def __init__(self, results: ProcessorResults, audio_file, bpm: int, rich_mode=False, sample_rate=44100,
+                 wav=True):
+        self.output_file = audio_file if hasattr(audio_file, "write") else str(audio_file)
+        self.bpm = bpm
+        self.rich_mode = rich_mode
+        self.sample_rate = sample_rate
+        self.wav = wav
+        super(AudioGeneratorProcessor, self).__init__(results)
 
-                    tone_beat += tone_midi_length
-            else:
-                rich_tone_length = self.results.default_bar_size // 8
-                rich_tone_real_length = bar_time * (rich_tone_length / bar.bar_size)
-                tone_accomp_curr = 0
-                rich_tone_seq_ndx = 0
-                while tone_accomp_curr < bar.bar_size:
-                    rich_tone = bar.get_tone_for_note_index(tone_accomp_curr)
-                    rich_tone_seq = [
-                        rich_tone.get_note_index_by_octave(3),
-                        rich_tone.get_note_index_by_octave(4),
-                        rich_tone.get_note_index_by_octave(4) + 4
-                        if rich_tone.type == ToneType.Dur else
-                        rich_tone.get_note_index_by_octave(4) + 3,
-                        rich_tone.get_note_index_by_octave(4)+7,
+    def process(self):
+        logging.info("Rendering audio...")
+        if hasattr(self.output_file, "write"):
+            self.write_audio(self.output_file)
+        else:
+            with open(self.output_file, "wb") as audio_f:
+                self.write_audio(audio_f)
+
+    def write_audio(self, stream):
+        import AudioWriter  # numpy is imported only when audio is rendered
+
+        audio = AudioWriter.PcmWriter(stream, self.sample_rate, self.wav)
+        melody_voice = AudioWriter.Voice([1, 0.5, 0.3, 0.15, 0.08], attack=0.005, decay=0.25, sustain=0.3,
+                                         release=0.08)
+        tone_voice = AudioWriter.Voice([1, 0.25, 0.1], attack=0.02, decay=0.6, sustain=0.5, release=0.15)
+        beat_time = 60 / self.bpm
+        try:
+            for bar_end_beat, melody_notes, tone_notes in self.bar_notes(self.rich_mode):
+                for voice, notes in ((melody_voice, melody_notes), (tone_voice, tone_notes)):
+                    for beat, pitch, velocity, length in notes:
+                        audio.add_note(beat * beat_time, pitch, velocity, length * beat_time, voice)
+                # following bars start no earlier than the end of this one
+                audio.flush(bar_end_beat * beat_time)
+        finally:
+            # an interrupted endless run still leaves a complete file
+            audio.close()
+
+
+class DatasetExportProcessor(DefaultProcessor):
+    # appends the bars as columnar note records to a DatasetWriter (or a MelodyCollector in worker processes)
+    def __init__(self, results: ProcessorResults, seed: str, sink):
+        self.seed = seed
+        self.sink = sink
+        super(DatasetExportProcessor, self).__init__(results)
 
-                    ]
-                    midi_tone_data.append([
-                        tone_beat, rich_tone_seq[rich_tone_seq_ndx], 90,
-                        rich_tone_real_length*(len(rich_tone_seq)-rich_tone_seq_ndx)
-                    ])
-                    rich_tone_seq_ndx = 0 if rich_tone_seq_ndx >= len(rich_tone_seq) - 1 else rich_tone_seq_ndx + 1
-                    tone_beat += rich_tone_real_length
-                    tone_accomp_curr += rich_tone_length
+    def process(self):
+        import DatasetExport
 
-        midi.add_track(midi_data)
-        midi.add_track(midi_tone_data)
-        midi.save_midi()
+        columns = DatasetExport.melody_columns(self.results.bars, self.results.default_bar_size)
+        self.sink.append(self.seed, columns, self.results.default_bar_size)
 
 # end of Processors.py
@@ -1,26 +1,45 @@
 import copy
-from MusicElements import Note, Tone, ToneType
+from MusicElements import Note, Tone, note_transitions
+from SeedRandomizer import ProbabilitySampler
 
 
 class SequenceSample:
-    def __init__(self, sequence_tone: Tone, notes: list):
+    def __init__(self, sequence_tone: Tone, notes: list, transposition_cache_size=24):
         self.tone = sequence_tone
         self.notes = notes
         self.friendly_samples = []
+        self.length = None
+        # transposed notes per target tone, there are only 24 tones
+        self.transposition_cache = dict()
+        self.transposition_cache_size = transposition_cache_size
+        self.transposition_hits = 0
+        self.transposition_misses = 0
 
     def get_length(self):
-        return sum([note.length for note in self.notes])
+        if self.length is None:
+            self.length = sum([note.length for note in self.notes])
+        return self.length
 
-    def get_transposed_notes(self, tone: Tone):
-        copied_notes = []
-        if tone.type == ToneType.Mol and tone.index == 9:
-            print("Am detected")
-        for note in self.notes:
-            copied_note: Note = copy.copy(note)
-            copied_note.transpose_note(self.tone, tone)
-            copied_notes.append(copied_note)
+    def get_transposed_notes(self, tone: Tone, mutable=False):
+        # the cached tuple is shared, ask for `mutable` notes to change them
+        transposed_notes = self.transposition_cache.get(tone)
+        if transposed_notes is None:
+            self.transposition_misses += 1
+            copied_notes = []
+            for note in self.notes:
+                copied_note: Note = copy.copy(note)
+                copied_note.transpose_note(self.tone, tone)
+                copied_notes.append(copied_note)
+            transposed_notes = tuple(copied_notes)
+            if len(self.transposition_cache) >= self.transposition_cache_size:
+                del self.transposition_cache[next(iter(self.transposition_cache))]
+            self.transposition_cache[tone] = transposed_notes
+        else:
+            self.transposition_hits += 1
 
-        return copied_notes
+        if mutable:
+            return [copy.copy(note) for note in transposed_notes]
+        return transposed_notes
 
     def get_first_note(self):
         return self.notes[0]
@@ -33,4 +52,62 @@ class SequenceSample:
 
     def __str__(self):
         return ", ".join([str(note) for note in self.notes])
+
+
+class SampleGraph:
+    # friend connections between samples compiled once after sample generation;
+    # selection weights never change, so every lookup is memoized
+
+    def __init__(self, samples: list):
+        self.samples = tuple(samples)
+        self.friends = {
+            id(sample): tuple((friend['sample'], friend['probability']) for friend in sample.friendly_samples)
+            for sample in self.samples
+        }
+        self._candidates = dict()
+        self._samplers = dict()
+        self._fitting_samples = dict()
+
+    def __reduce__(self):
+        # lookups are keyed by object ids, so a copy in another process is compiled again
+        return SampleGraph, (self.samples,)
+
+    def candidates(self, sample: SequenceSample, max_length) -> tuple:
+        # friends of `sample` which fit into `max_length`
+        key = (id(sample), max_length)
+        candidates = self._candidates.get(key)
+        if candidates is None:
+            candidates = tuple((friend, probability) for friend, probability in self.friends[id(sample)]
+                               if friend.get_length() <= max_length)
+            self._candidates[key] = candidates
+        return candidates
+
+    def next_sampler(self, previous: SequenceSample, tone: Tone, max_length):
+        # None when no friend of `previous` fits into `max_length`
+        key = (id(previous), tone, max_length)
+        if key not in self._samplers:
+            candidates = self.candidates(previous, max_length)
+            if len(candidates) == 0:
+                self._samplers[key] = None
+            else:
+                next_probabilities = dict()
+                for prob_note in note_transitions.candidates(tone, previous.get_last_note().pitch):
+                    next_probabilities.setdefault(prob_note['note_index'], prob_note['probability'])
+                weights = []
+                for friend, probability in candidates:
+                    next_probability = next_probabilities.get(friend.get_first_note().pitch)
+                    if next_probability is None:  # if it's `strange` range jump make it almost impossible
+                        weights.append(0.01)
+                    else:
+                        weights.append(probability * next_probability)
+                self._samplers[key] = ProbabilitySampler([friend for friend, _ in candidates], weights)
+        return self._samplers[key]
+
+    def samples_fitting(self, max_length) -> list:
+        samples = self._fitting_samples.get(max_length)
+        if samples is None:
+            samples = [sample for sample in self.samples if sample.get_length() <= max_length]
+            self._fitting_samples[max_length] = samples
+        return samples
+
 # end RepetitiveElements.py
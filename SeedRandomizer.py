@@ -1,5 +1,8 @@
 import random
 import hashlib
+import bisect
+
+import Metrics
 
 
 def generate_seed():
@@ -12,23 +15,48 @@ def generate_seed():
     return hash_gen.hexdigest()[0:12]
 
 
-def random_from_sorted_set(input_set : set):
-    items = list(input_set)
-    return random.choice(sorted(items))
-
-
-def random_from_probability_list(sequence: list(dict())):
-    if len(sequence) == 0:
-        raise ValueError("Sequence can not be empty.")
-
-    probability_grip = 0
-    for item in sequence:
-        probability_grip += item['probability']
-        item['probability_range_end'] = probability_grip
+def derive_seed(seed, *stream_path) -> int:
+    # an independent, reproducible sub-seed for a named stream (stage, chunk...) of a master seed
+    stream_hash = hashlib.sha256(repr((seed,) + stream_path).encode("utf-8"))
+    return int.from_bytes(stream_hash.digest()[0:8], "big")
 
-    probability_sum = sum([item['probability'] for item in sequence])
-    random_shot = random.random()*probability_sum
 
-    for item in sequence:
-        if item['probability_range_end'] > random_shot:
-            return item
+def random_from_sorted_set(input_set : set, rng=random):
+    items = list(input_set)
+    return rng.choice(sorted(items))
+
+
+class ProbabilitySampler:
+    # picks by bisect over cumulative weights; draws exactly the same items
+    # as the linear scan of random_from_probability_list for a given seed
+    def __init__(self, items: list, weights: list):
+        if len(items) == 0:
+            raise ValueError("Sequence can not be empty.")
+        if len(items) != len(weights):
+            raise ValueError("Every item needs exactly one weight.")
+        self.items = tuple(items)
+        cumulative = []
+        probability_grip = 0
+        for weight in weights:
+            probability_grip += weight
+            cumulative.append(probability_grip)
+        self.cumulative = tuple(cumulative)
+        self.total = sum(weights)
+        Metrics.counters['probability_lists_built'] += 1
+
+    @classmethod
+    def from_probability_list(cls, sequence: list(dict())):
+        return cls(sequence, [item['probability'] for item in sequence])
+
+    def __len__(self):
+        return len(self.items)
+
+    def draw(self, rng=random):
+        Metrics.counters['sampler_draws'] += 1
+        random_shot = rng.random()*self.total
+        item_ndx = bisect.bisect_right(self.cumulative, random_shot)
+        return self.items[min(item_ndx, len(self.items) - 1)]
+
+
+def random_from_probability_list(sequence: list(dict()), rng=random):
+    return ProbabilitySampler.from_probability_list(sequence).draw(rng)
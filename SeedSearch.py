@@ -0,0 +1,201 @@
+import os
+import sys
+import time
+import itertools
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import SeedRandomizer
+import Pipeline
+import Processors
+from MusicElements import ToneType
+
+# count of processors which must run before a stage's criteria can be decided
+STAGE_PROCESSORS = {
+    'tones': 2,  # elements, tones
+    'samples': 3,  # + sequence samples
+    'bars': 4  # + bars
+}
+SEEDS_PER_JOB = 64
+
+
+def _cyclic_contains(sequence: list, part: list) -> bool:
+    doubled = sequence + sequence[:len(part) - 1]
+    return any(doubled[ndx:ndx + len(part)] == part for ndx in range(0, len(sequence)))
+
+
+def _sample_pitches(results: Processors.ProcessorResults) -> list:
+    return [note.pitch for sample in results.sequence_samples for note in sample.notes if not note.silent]
+
+
+def _repetition(results: Processors.ProcessorResults) -> float:
+    transcriptions = [str(bar) for bar in results.bars]
+    return 1 - len(set(transcriptions)) / len(transcriptions)
+
+
+def _density(results: Processors.ProcessorResults) -> float:
+    return sum(1 for bar in results.bars for note in bar.notes.values() if not note.silent) / len(results.bars)
+
+
+# criterion name -> (stage, measure of the results); range criteria are `name=MIN:MAX` (a side may be empty),
+# `primary` and `progression` take tones in the --tones format
+CRITERIA = {
+    'primary': ('tones', lambda results: results.primary_tone),
+    'progression': ('tones', lambda results: results.tone_sequence),
+    'tones': ('tones', lambda results: len(results.tone_sequence)),
+    'minor': ('tones', lambda results: sum(1 for tone in results.tone_sequence if tone.type == ToneType.Mol)
+              / len(results.tone_sequence)),
+    'samples': ('samples', lambda results: len(results.sequence_samples)),
+    'pitch_range': ('samples', lambda results: max(_sample_pitches(results), default=0)
+                    - min(_sample_pitches(results), default=0)),
+    'density': ('bars', _density),
+    'repetition': ('bars', _repetition)
+}
+
+
+def _describe(measured):
+    # tones are sent back to the parent process as text
+    if isinstance(measured, list):
+        return ",".join(str(tone) for tone in measured)
+    return measured if isinstance(measured, (int, float)) else str(measured)
+
+
+def parse_criteria(specs: list) -> list:
+    # `name=value` specs -> (name, stage, value) sorted by the stage deciding them
+    criteria = []
+    for spec in specs:
+        name, _, value = spec.partition("=")
+        if name not in CRITERIA or value == "":
+            raise ValueError("Unknown search criterion `" + spec + "`, expected one of: "
+                             + ", ".join(name + "=..." for name in CRITERIA))
+        try:
+            if name == 'primary':
+                parsed = Processors.ToneGeneratorProcessor.parse_tone(value)[0]
+            elif name == 'progression':
+                parsed = [Processors.ToneGeneratorProcessor.parse_tone(tone_str)[0] for tone_str in value.split(",")]
+            else:
+                low, _, high = value.partition(":") if ":" in value else (value, None, value)
+                parsed = (float(low) if low != "" else None, float(high) if high != "" else None)
+        except (KeyError, IndexError, ValueError):
+            raise ValueError("Malformed search criterion `" + spec + "`")
+        criteria.append((name, CRITERIA[name][0], parsed))
+    return sorted(criteria, key=lambda criterion: STAGE_PROCESSORS[criterion[1]])
+
+
+def criterion_matches(name: str, expected, measured) -> bool:
+    if name == 'primary':
+        return measured is expected
+    if name == 'progression':
+        return _cyclic_contains(measured, expected)
+    low, high = expected
+    return (low is None or measured >= low) and (high is None or measured <= high)
+
+
+def check_seed(seed: str, criteria: list, options: dict):
+    # runs processors only until every criterion is decided;
+    # returns (measures, None) for a kept seed or (None, rejecting stage)
+    results = Processors.ProcessorResults()
+    processors = Pipeline.build_processors(results, None, seed=seed,
+                                           randoms=Pipeline.stage_randoms(seed, options.get('chunk_bars', 0) > 0),
+                                           midi=False, **options)
+    processed = 0
+    measures = {}
+    for name, stage, expected in criteria:
+        while processed < STAGE_PROCESSORS[stage]:
+            processors[processed].process()
+            processed += 1
+        measured = CRITERIA[name][1](results)
+        if not criterion_matches(name, expected, measured):
+            return None, stage
+        measures[name] = _describe(measured)
+    return measures, None
+
+
+def _write_job(seed: str, output_file: str, options: dict):
+    # the whole pipeline runs again only for kept seeds
+    Pipeline.generate(seed, output_file, **options)
+
+
+def _search_job(seeds: list, criteria: list, options: dict) -> tuple:
+    matches = []
+    rejections = {}
+    for seed in seeds:
+        measures, rejecting_stage = check_seed(seed, criteria, options)
+        if measures is not None:
+            matches.append((seed, measures))
+        else:
+            rejections[rejecting_stage] = rejections.get(rejecting_stage, 0) + 1
+    return len(seeds), matches, rejections
+
+
+def random_seeds(count: int = 0):
+    # `count` random seeds, endless for 0
+    counter = itertools.count() if count == 0 else range(0, count)
+    for _ in counter:
+        yield SeedRandomizer.generate_seed()
+
+
+def search(seeds, criteria: list, options: dict, workers: int = None, output_dir: str = None, limit: int = 0,
+           stats: dict = None):
+    # yields (seed, measures) of matching seeds as workers find them; a bounded window
+    # of jobs in flight lets `seeds` be an endless generator. With `output_dir` MIDI files
+    # of yielded seeds are written by the same workers.
+    seeds = iter(seeds)
+    options = dict(options, streaming=False)
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    stats = stats if stats is not None else {}
+    stats.update({'checked': 0, 'matched': 0, 'rejected': {stage: 0 for stage in STAGE_PROCESSORS}})
+    seed_chunks = iter(lambda: list(itertools.islice(seeds, SEEDS_PER_JOB)), [])
+    with ProcessPoolExecutor(max_workers=workers, initializer=Pipeline.silence_worker) as executor:
+        window = 4 * (workers or os.cpu_count() or 1)
+        pending = set()
+        writes = []
+        try:
+            while True:
+                for seed_chunk in itertools.islice(seed_chunks, window - len(pending)):
+                    pending.add(executor.submit(_search_job, seed_chunk, criteria, options))
+                if not pending:
+                    return
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for job in done:
+                    checked, matches, rejections = job.result()
+                    stats['checked'] += checked
+                    for stage, count in rejections.items():
+                        stats['rejected'][stage] += count
+                    for match in matches:
+                        stats['matched'] += 1
+                        if output_dir is not None:
+                            writes.append(executor.submit(_write_job, match[0],
+                                                          os.path.join(output_dir, match[0] + ".mid"), options))
+                        yield match
+                        if 0 < limit <= stats['matched']:
+                            return
+        finally:
+            for job in pending:
+                job.cancel()
+            for write in writes:
+                write.result()
+
+
+def print_match(seed: str, measures: dict):
+    print(seed + "\t" + " ".join(name + "=" + (format(value, ".3g") if isinstance(value, float) else str(value))
+                                 for name, value in measures.items()), flush=True)
+
+
+def print_stats(stats: dict, wall_time: float):
+    print("Checked " + str(stats['checked']) + " seeds in " + format(wall_time, ".2f") + "s ("
+          + format(stats['checked'] / wall_time if wall_time > 0 else 0.0, ".0f") + " seeds/s), matched "
+          + str(stats['matched']) + ", rejected after "
+          + ", ".join(stage + ": " + str(count) for stage, count in stats['rejected'].items()), file=sys.stderr)
+
+
+def run_search(seeds, specs: list, options: dict, workers: int = None, output_dir: str = None, limit: int = 0):
+    criteria = parse_criteria(specs)
+    stats = {}
+    start = time.perf_counter()
+    try:
+        for seed, measures in search(seeds, criteria, options, workers, output_dir, limit, stats):
+            print_match(seed, measures)
+    except KeyboardInterrupt:
+        pass
+    print_stats(stats, time.perf_counter() - start)
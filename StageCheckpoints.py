@@ -0,0 +1,91 @@
+import json
+import pickle
+import hashlib
+
+import Pipeline
+import Processors
+import OutputCache
+import Transcription
+
+# memoized stages (processor index -> name); elements are cached by ElementsParserProcessor
+# and output stages depend on options like bpm or rich, so they always run
+MEMOIZED_STAGES = {1: "tones", 2: "samples", 3: "bars"}
+
+
+class StageCheckpoints:
+    # ProcessorResults after every memoized stage, stored under a key chained from the
+    # upstream key and the options the stage reads; a re-run resumes after the deepest
+    # stored stage, so e.g. a --bpm or --rich change runs only the output stages.
+    # Storage, LRU eviction and stats are those of an OutputCache with `.stage` entries
+
+    def __init__(self, directory: str, max_size: int = 256 * 1024 * 1024):
+        self.store = OutputCache.OutputCache(directory, max_size, suffix=".stage")
+
+    def stage_keys(self, seed: str, options: dict) -> dict:
+        stage_options = {
+            'tones': {'tones': options.get('tones', "")},
+            'samples': {},
+            'bars': {name: options.get(name, default) for name, default in
+                     (('bars', 32), ('continuous', False), ('chunk_bars', 0), ('compounding_friends', False))}
+        }
+        key = json.dumps({
+            'seed': seed,
+            'chunked': options.get('chunk_bars', 0) > 0,
+            'elements': OutputCache.file_hash(options.get('elements_file', Pipeline.ELEMENTS_FILE)),
+            'code': OutputCache.code_version()
+        }, sort_keys=True)
+        keys = {}
+        for stage_ndx, stage in MEMOIZED_STAGES.items():
+            key = hashlib.sha256((key + stage + json.dumps(stage_options[stage], sort_keys=True)).encode()).hexdigest()
+            keys[stage_ndx] = key
+        return keys
+
+    def load(self, key: str):
+        checkpoint = self.store.get(key)
+        if checkpoint is None:
+            return None
+        try:
+            return pickle.loads(checkpoint)
+        except (EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+
+    def save(self, key: str, results: Processors.ProcessorResults, randoms: dict):
+        # random states are stored too, later stages continue the same streams
+        self.store.put(key, pickle.dumps({
+            'results': results.stage_state(),
+            'randoms': {stage: rng.getstate() for stage, rng in randoms.items()}
+        }, pickle.HIGHEST_PROTOCOL))
+
+    def run(self, seed: str, output_file, metrics=None, **options) -> Processors.ProcessorResults:
+        # Pipeline.generate resuming after the deepest stored stage
+        randoms = Pipeline.stage_randoms(seed, options.get('chunk_bars', 0) > 0)
+        results = Processors.ProcessorResults()
+        processors = Pipeline.build_processors(results, output_file, seed=seed, randoms=randoms, **options)
+        keys = self.stage_keys(seed, options)
+        if options.get('streaming', False):
+            del keys[3]  # streamed bars are not stored
+
+        # the elements stage always runs, it is a lookup of the compiled elements cache
+        resume_ndx = 1
+        for stage_ndx in sorted(keys, reverse=True):
+            checkpoint = self.load(keys[stage_ndx])
+            if checkpoint is not None:
+                results.restore_stage_state(checkpoint['results'])
+                for stage, state in checkpoint['randoms'].items():
+                    randoms[stage].setstate(state)
+                resume_ndx = stage_ndx + 1
+                break
+        # skipped stages transcribe nothing, their restored results are transcribed instead
+        Transcription.replay(options.get('transcript'), results,
+                             [MEMOIZED_STAGES[stage_ndx] for stage_ndx in range(1, resume_ndx)])
+
+        for processor_ndx, processor in enumerate(processors):
+            if 0 < processor_ndx < resume_ndx:
+                continue
+            if metrics is not None:
+                metrics.measure(processor)
+            else:
+                processor.process()
+            if processor_ndx in keys and processor_ndx >= resume_ndx:
+                self.save(keys[processor_ndx], results, randoms)
+        return results
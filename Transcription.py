@@ -0,0 +1,100 @@
+import sys
+import json
+
+SECTIONS = ("tones", "samples", "bars")
+
+
+class TranscriptionWriter:
+    # buffers the transcription (a line per tone sequence, sample and bar) and writes it in
+    # blocks of about `buffer_size` characters; JSON form is one object per line. Every generation
+    # gets its own writer (like its random streams), passed to the stages by build_processors
+
+    def __init__(self, stream, json_format=False, sections=SECTIONS, buffer_size=1 << 16):
+        for section in sections:
+            if section not in SECTIONS:
+                raise ValueError("Unknown transcription section `" + section + "`")
+        self.stream = stream
+        self.json_format = json_format
+        self.sections = frozenset(sections)
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.bar_count = 0
+
+    def write_line(self, line: str):
+        self.buffer.append(line + "\n")
+        self.buffered += len(line) + 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def write_json(self, record: dict):
+        self.write_line(json.dumps(record, ensure_ascii=False))
+
+    def tone_sequence(self, tones: list, lengths: list):
+        self.record({'tones': [tone.name for tone in tones], 'lengths': lengths})
+
+    def sample(self, sample):
+        self.record({'sample': [str(note) for note in sample.notes]})
+
+    def bar(self, bar):
+        self.record({'bar': self.bar_count, 'notes': [str(note) for note in bar.notes.values()],
+                     'tones': [tone.name for tone in bar.tones.values()]})
+
+    def record(self, record: dict):
+        # writes a record of the JSON form (also one read back from a stored transcription)
+        # in the format of this writer, when its section is transcribed
+        if 'bar' in record:
+            if "bars" not in self.sections:
+                return
+            record = dict(record, bar=self.bar_count)
+            self.bar_count += 1
+            line = "| " + "".join([note + " " for note in record['notes']]) + "/".join(record['tones']) + "|"
+        elif 'sample' in record:
+            if "samples" not in self.sections:
+                return
+            line = ", ".join(record['sample'])
+        else:
+            if "tones" not in self.sections:
+                return
+            line = "".join([str(length) + tone + " " for tone, length in zip(record['tones'], record['lengths'])])
+        self.write_line(json.dumps(record, ensure_ascii=False) if self.json_format else line)
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write("".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+        if self.stream not in (sys.stdout, sys.stderr, sys.__stdout__, sys.__stderr__):
+            self.stream.close()
+
+
+def writer_for(writer: TranscriptionWriter, section: str):
+    # `writer` when it transcribes `section`, None otherwise; stages ask once before their loops,
+    # so nothing is formatted while transcription (or its section) is disabled
+    if writer is not None and section in writer.sections:
+        return writer
+    return None
+
+
+def replay(writer: TranscriptionWriter, results, sections):
+    # transcribes `sections` of results restored instead of generated (e.g. from stage checkpoints)
+    if writer_for(writer, "tones") is not None and "tones" in sections:
+        writer.tone_sequence(results.tone_sequence, results.tone_length_sequence)
+    if writer_for(writer, "samples") is not None and "samples" in sections:
+        for sample in results.sequence_samples:
+            writer.sample(sample)
+    if writer_for(writer, "bars") is not None and "bars" in sections:
+        for bar in results.bars:
+            writer.bar(bar)
+
+
+def replay_stored(writer: TranscriptionWriter, stored: str):
+    # transcribes a stored JSON form transcription (of every section) again
+    if writer is None:
+        return
+    for line in stored.splitlines():
+        writer.record(json.loads(line))
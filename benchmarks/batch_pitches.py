@@ -0,0 +1,113 @@
+# Pitch assignment throughput of the NumPy batch engine compared with note by note sampling,
+# after checking the engine keeps the rules of the note by note generators.
+# usage: python benchmarks/batch_pitches.py [-m 10000] [-n 64]
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy  # noqa: E402
+
+from BatchPitchEngine import BatchPitchEngine, TONES, SILENT_PITCH  # noqa: E402
+from MusicElements import NoteTransitionTable, note_transitions  # noqa: E402
+
+
+def scalar_pitches(tone_ids, harmonic_flags, silent_flags, start_pitches, rng) -> list:
+    melodies = []
+    for melody_ndx in range(0, len(tone_ids)):
+        previous_pitch = int(start_pitches[melody_ndx])
+        pitches = [previous_pitch]
+        for note_ndx in range(1, len(tone_ids[melody_ndx])):
+            if silent_flags[melody_ndx][note_ndx]:
+                pitches.append(-1)
+                continue
+            tone = TONES[tone_ids[melody_ndx][note_ndx]]
+            if harmonic_flags[melody_ndx][note_ndx]:
+                sampler = note_transitions.harmonic_sampler(tone, previous_pitch)
+                previous_pitch = tone.get_note_index_by_octave(5) if sampler is None else sampler.draw(rng)
+            else:
+                previous_pitch = note_transitions.non_harmonic_sampler(tone, previous_pitch).draw(rng)
+            pitches.append(previous_pitch)
+        melodies.append(pitches)
+    return melodies
+
+
+class NoNonHarmonicTable(NoteTransitionTable):
+    # a table whose non-harmonic rows are all empty
+    def non_harmonic_candidates(self, tone, pitch):
+        return ()
+
+
+def allowed_pitch(tone, previous_pitch, harmonic, pitch) -> bool:
+    if harmonic:
+        candidates = note_transitions.harmonic_candidates(tone, previous_pitch)
+        if not candidates:
+            return pitch == tone.get_note_index_by_octave(5)
+    else:
+        candidates = note_transitions.non_harmonic_candidates(tone, previous_pitch)
+    return any(note['note_index'] == pitch for note in candidates)
+
+
+def check_rules(engine, tone_ids, harmonic_flags, silent_flags, start_pitches, melodies=200):
+    # raises ValueError when a batch breaks a rule of the note by note generators
+    tone_ids, harmonic_flags = tone_ids[:melodies], harmonic_flags[:melodies]
+    silent_flags, start_pitches = silent_flags[:melodies], start_pitches[:melodies]
+    for first_fixed in (True, False):
+        pitches = engine.assign_pitches(tone_ids, harmonic_flags, silent_flags, start_pitches, 0, first_fixed)
+        for melody_ndx in range(0, len(pitches)):
+            previous_pitch = int(start_pitches[melody_ndx])
+            for note_ndx, pitch in enumerate(pitches[melody_ndx].tolist()):
+                if note_ndx == 0 and first_fixed:
+                    if pitch != previous_pitch:
+                        raise ValueError("A fixed first note does not get the start pitch.")
+                    continue
+                if silent_flags[melody_ndx, note_ndx]:
+                    if pitch != SILENT_PITCH:
+                        raise ValueError("A silent note got a pitch.")
+                    continue
+                if not allowed_pitch(TONES[tone_ids[melody_ndx, note_ndx]], previous_pitch,
+                                     harmonic_flags[melody_ndx, note_ndx], pitch):
+                    raise ValueError("A pitch is not a candidate of its previous pitch.")
+                previous_pitch = pitch
+    try:
+        BatchPitchEngine(NoNonHarmonicTable()).assign_pitches(tone_ids, numpy.zeros_like(harmonic_flags),
+                                                              numpy.zeros_like(silent_flags), start_pitches, 0)
+    except ValueError:
+        return
+    raise ValueError("An empty non-harmonic row does not raise.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Syncopa batch pitch engine benchmark")
+    parser.add_argument("-m", "--melodies", type=int, default=10000, help="Count of melodies")
+    parser.add_argument("-n", "--notes", type=int, default=64, help="Count of notes per melody")
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    tone_ids = rng.integers(0, len(TONES), (args.melodies, args.notes))
+    harmonic_flags = rng.random((args.melodies, args.notes)) < 0.6
+    silent_flags = rng.random((args.melodies, args.notes)) < 0.1
+    engine = BatchPitchEngine()
+    start_pitches = engine.primary_pitches[tone_ids[:, 0]]
+    engine.build(range(0, len(TONES)))
+    note_count = args.melodies * args.notes
+    check_rules(engine, tone_ids, harmonic_flags, silent_flags, start_pitches)
+    print("rules: ok")
+
+    start = time.perf_counter()
+    engine.assign_pitches(tone_ids, harmonic_flags, silent_flags, start_pitches, rng)
+    batch_time = time.perf_counter() - start
+    print("batch: " + format(batch_time, ".3f") + "s, " + format(note_count / batch_time, ".0f") + " notes/s")
+
+    start = time.perf_counter()
+    scalar_pitches(tone_ids.tolist(), harmonic_flags.tolist(), silent_flags.tolist(), start_pitches, random.Random(0))
+    scalar_time = time.perf_counter() - start
+    print("scalar: " + format(scalar_time, ".3f") + "s, " + format(note_count / scalar_time, ".0f") + " notes/s (x"
+          + format(scalar_time / batch_time, ".1f") + ")")
+
+
+if __name__ == "__main__":
+    main()
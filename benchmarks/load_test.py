@@ -0,0 +1,72 @@
+# Load test of the generation server (main.py --serve) on localhost.
+# usage: python benchmarks/load_test.py [--port 8000] [-n 200] [-c 16] [-b 32] [--rich]
+import time
+import asyncio
+import argparse
+import statistics
+from urllib.parse import urlencode
+
+
+async def fetch(host: str, port: int, path: str) -> tuple:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(("GET " + path + " HTTP/1.1\r\nHost: " + host + "\r\nConnection: close\r\n\r\n").encode())
+        await writer.drain()
+        status_line = await reader.readline()
+        status = int(status_line.split()[1])
+        content_length = 0
+        while True:
+            header_line = await reader.readline()
+            if header_line in (b"\r\n", b""):
+                break
+            name, _, value = header_line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                content_length = int(value)
+        body = await reader.readexactly(content_length)
+        return status, body
+    finally:
+        writer.close()
+
+
+async def client(args, request_ndxs: list, latencies: list, statuses: dict):
+    for request_ndx in request_ndxs:
+        query = {'seed': "load" + str(request_ndx), 'bars': args.bars}
+        if args.rich:
+            query['rich'] = 1
+        start = time.perf_counter()
+        status, _ = await fetch(args.host, args.port, "/generate?" + urlencode(query))
+        latencies.append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+
+
+async def load_test(args):
+    latencies = []
+    statuses = {}
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args, list(range(client_ndx, args.requests, args.concurrency)), latencies, statuses)
+                           for client_ndx in range(0, args.concurrency)])
+    wall_time = time.perf_counter() - start
+
+    latencies.sort()
+    print("Requests: " + str(len(latencies)) + " in " + format(wall_time, ".2f") + "s ("
+          + format(len(latencies) / wall_time, ".1f") + " req/s), statuses: " + str(statuses))
+    print("Latency: median " + format(statistics.median(latencies) * 1000, ".1f") + "ms, p95 "
+          + format(latencies[int(len(latencies) * 0.95) - 1] * 1000, ".1f") + "ms, max "
+          + format(latencies[-1] * 1000, ".1f") + "ms")
+    _, status_body = await fetch(args.host, args.port, "/status")
+    print("Server status: " + status_body.decode())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Syncopa generation server load test")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("-n", "--requests", type=int, default=200, help="Count of requests")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="Count of concurrent clients")
+    parser.add_argument("-b", "--bars", type=int, default=32, help="Count of bars per melody")
+    parser.add_argument("--rich", action="store_true")
+    asyncio.run(load_test(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# Bytes per note of the slotted Note compared with the former __dict__ based layout.
+# usage: python benchmarks/note_memory.py [NOTE_COUNT]
+import os
+import sys
+import copy
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from MusicElements import Note  # noqa: E402
+
+
+class DictNote:
+    # the Note layout before __slots__: a per-instance __dict__ with the atomic dict reference
+    def __init__(self, length, atomic):
+        self.silent = False
+        self.pitch = 60
+        self.velocity = 128
+        self.length = length
+        self.atomic = atomic
+        self.harmonic_flag = False
+        self.finalized = False
+
+
+def bytes_per_note(note_class, count: int) -> float:
+    atomic = {"representation": "♩", "length": 8}
+    template = note_class(atomic["length"], atomic)
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    notes = []
+    for ndx in range(0, count):
+        note = copy.copy(template)
+        note.pitch = 48 + ndx % 36
+        notes.append(note)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # the list of references is the same for both layouts
+    return (after - before) / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    dict_bytes = bytes_per_note(DictNote, count)
+    slot_bytes = bytes_per_note(Note, count)
+    print("Notes: " + str(count))
+    print("__dict__ note: " + format(dict_bytes, ".1f") + " bytes per note")
+    print("__slots__ note: " + format(slot_bytes, ".1f") + " bytes per note")
+    print("Saved: " + format(100 * (1 - slot_bytes / dict_bytes), ".1f") + "%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# Times every pipeline stage and the whole pipeline over a fixed seed corpus.
+# usage: python benchmarks/pipeline.py [-b 32,1000,10000,100000] [-s qwerty,rawr,seed] [-o results.json]
+#        python benchmarks/pipeline.py --compare OLD.json NEW.json
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import contextlib
+import subprocess
+import statistics
+import tracemalloc
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_DIR)
+
+import Pipeline  # noqa: E402
+import Processors  # noqa: E402
+
+SEED_CORPUS = ["qwerty", "01b525321a3e", "mementomori", "seed", "rawr"]
+BAR_COUNTS = [32, 1000, 10000, 100000]
+
+
+def run_pipeline(seed: str, bars: int, continuous: bool, rich: bool, trace_memory: bool) -> dict:
+    random.seed(seed)
+    results = Processors.ProcessorResults()
+    processors = Pipeline.build_processors(results, io.BytesIO(), bars=bars, continuous=continuous, rich=rich,
+                                           elements_file=os.path.join(REPO_DIR, Pipeline.ELEMENTS_FILE))
+    stages = {}
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for processor in processors:
+            stage_start = time.perf_counter()
+            processor.process()
+            stages[type(processor).__name__] = time.perf_counter() - stage_start
+    total = time.perf_counter() - start
+    peak_memory = None
+    if trace_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    generated_bars = len(results.bars)
+    return {
+        'seed': seed,
+        'mode': "continuous" if continuous else "sample",
+        'rich': rich,
+        'bars': generated_bars,
+        'stages': stages,
+        'total': total,
+        'time_per_bar': total / generated_bars,
+        'peak_memory': peak_memory
+    }
+
+
+def summary_key(run: dict) -> str:
+    return run['mode'] + ("/rich" if run['rich'] else "/normal") + "/" + str(run['bars'])
+
+
+def summarize(runs: list) -> dict:
+    grouped = {}
+    for run in runs:
+        grouped.setdefault(summary_key(run), []).append(run)
+    summary = {}
+    for key, group in grouped.items():
+        stage_names = group[0]['stages'].keys()
+        memory = [run['peak_memory'] for run in group if run['peak_memory'] is not None]
+        summary[key] = {
+            'runs': len(group),
+            'stages': {name: statistics.median(run['stages'][name] for run in group) for name in stage_names},
+            'total': statistics.median(run['total'] for run in group),
+            'time_per_bar': statistics.median(run['time_per_bar'] for run in group),
+            'peak_memory': max(memory) if memory else None
+        }
+    return summary
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def benchmark(seeds: list, bar_counts: list, trace_memory: bool) -> dict:
+    runs = []
+    for seed in seeds:
+        for rich in (False, True):
+            for bars in bar_counts:
+                run = run_pipeline(seed, bars, False, rich, False)
+                if trace_memory:
+                    # a separate pass, tracing slows the timed stages down
+                    run['peak_memory'] = run_pipeline(seed, bars, False, rich, True)['peak_memory']
+                runs.append(run)
+                print_run(run)
+            # continuous mode always generates the same count of bars
+            run = run_pipeline(seed, 0, True, rich, False)
+            if trace_memory:
+                run['peak_memory'] = run_pipeline(seed, 0, True, rich, True)['peak_memory']
+            runs.append(run)
+            print_run(run)
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'seeds': seeds,
+            'bar_counts': bar_counts
+        },
+        'runs': runs,
+        'summary': summarize(runs)
+    }
+
+
+def print_run(run: dict):
+    stages = ", ".join(name.replace("Processor", "") + " " + format(seconds * 1000, ".1f") + "ms"
+                       for name, seconds in run['stages'].items())
+    memory = "" if run['peak_memory'] is None else ", peak " + format(run['peak_memory'] / 1024, ".0f") + "KiB"
+    print(run['seed'] + " " + summary_key(run) + ": " + format(run['total'] * 1000, ".1f") + "ms, "
+          + format(run['time_per_bar'] * 1000000, ".1f") + "us/bar" + memory + " (" + stages + ")")
+
+
+def compare(old_file: str, new_file: str):
+    with open(old_file) as old_f, open(new_file) as new_f:
+        old = json.load(old_f)
+        new = json.load(new_f)
+    print("Comparing " + old['meta']['commit'] + " -> " + new['meta']['commit'])
+    for key, new_summary in new['summary'].items():
+        old_summary = old['summary'].get(key)
+        if old_summary is None:
+            continue
+        line = key + ": " + format(old_summary['time_per_bar'] * 1000000, ".1f") + " -> " \
+            + format(new_summary['time_per_bar'] * 1000000, ".1f") + "us/bar (x" \
+            + format(old_summary['time_per_bar'] / new_summary['time_per_bar'], ".2f") + ")"
+        if old_summary['peak_memory'] and new_summary['peak_memory']:
+            line += ", peak " + format(old_summary['peak_memory'] / 1024, ".0f") + " -> " \
+                + format(new_summary['peak_memory'] / 1024, ".0f") + "KiB"
+        print(line)
+        for stage, seconds in new_summary['stages'].items():
+            if stage in old_summary['stages']:
+                print("    " + stage + ": " + format(old_summary['stages'][stage] * 1000, ".2f") + " -> "
+                      + format(seconds * 1000, ".2f") + "ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Syncopa pipeline benchmark")
+    parser.add_argument("-b", "--bars", type=str, default=",".join(str(b) for b in BAR_COUNTS),
+                        help="Comma separated bar counts")
+    parser.add_argument("-s", "--seeds", type=str, default=",".join(SEED_CORPUS),
+                        help="Comma separated seed corpus")
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json", help="JSON results file")
+    parser.add_argument("--no-memory", help="Skips the peak memory pass", action="store_true")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compares two JSON results files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = benchmark(args.seeds.split(","), [int(bars) for bars in args.bars.split(",")], not args.no_memory)
+    with open(args.output, "w") as results_f:
+        json.dump(results, results_f, indent=2)
+    print("Results saved to " + args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# Wall time of short command line runs, where interpreter startup and imports dominate.
+# usage: python benchmarks/startup.py [-n 10]
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def startup_commands(output_file: str) -> dict:
+    return {
+        'python': [],
+        'help': ["main.py", "--help"],
+        'preview': ["main.py", "-s", "qwerty", "-b", "8", "--no-midi"],
+        'midi': ["main.py", "-s", "qwerty", "-b", "8", "-o", output_file]
+    }
+
+
+def time_command(arguments: list, runs: int) -> float:
+    command = [sys.executable] + (arguments or ["-c", "pass"])
+    timings = []
+    for _ in range(0, runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Syncopa command line startup benchmark")
+    parser.add_argument("-n", "--runs", type=int, default=10, help="Count of runs per command (median is reported)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, arguments in startup_commands(os.path.join(temp_dir, "startup.mid")).items():
+            print(name + ": " + format(time_command(arguments, args.runs) * 1000, ".1f") + "ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,289 @@
-import random
+import os
+import sys
 import argparse
+import collections
 import logging
-import SeedRandomizer
 
-import Processors
-
-
-print("Narcotic melody generator by srsly_4 / Szymon Piechaczek, 2017")
+# generation modules are imported by the mode that needs them, so --help and
+# argument errors do not pay for the tone and transition tables
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Narcotic melody generator")
-    parser.add_argument("-s", "--seed", type=str, help="A seed to melody generation process",
-                        default=SeedRandomizer.generate_seed())
+    parser.add_argument("-s", "--seed", type=str, help="A seed to melody generation process (random by default)",
+                        default=None)
     parser.add_argument("-o", "--output", type=str,
-                        help="Output file name", default="output.mid")
+                        help="Output file name (- writes to stdout)", default="output.mid")
     parser.add_argument("-b", "--bars", type=int,
                         default=32,
-                        help="Count of generated bars")
+                        help="Count of generated bars (0 with --stream generates bars endlessly)")
     parser.add_argument("-t", "--tones", type=str, default="")
     parser.add_argument("--bpm", type=int, default=120, help="Beats per minute (tempo)")
     parser.add_argument("--continuous", help="Generates melody using continuous sample creation", action="store_true")
     parser.add_argument("--rich", help="Another implementation of accompaniment", action="store_true")
+    parser.add_argument("--compounding-friends", action="store_true",
+                        help="Chooses following samples with friend weights compounding across bars, like versions "
+                             "before the sample graph (melodies of seeds shared before)")
+    parser.add_argument("--stream", help="Generates bars lazily while the MIDI stage consumes them",
+                        action="store_true")
+    parser.add_argument("--midi-backend", choices=["native", "miditime"], default="native",
+                        help="MIDI encoder (miditime requires the miditime library)")
+    parser.add_argument("--chunk-bars", type=int, default=0, metavar="N",
+                        help="Generates bars in independent chunks of N bars, every stage drawing from its own "
+                             "stream derived from the seed (melodies differ from the default mode)")
+    parser.add_argument("--bar-workers", type=int, default=1,
+                        help="Count of processes generating chunks of bars (requires --chunk-bars)")
+    parser.add_argument("--no-midi", help="Prints the text transcription of the melody instead of writing MIDI",
+                        action="store_true")
+    parser.add_argument("--audio", type=str, default=None, metavar="FILE",
+                        help="Also renders the melody to a WAV file (raw 16-bit PCM for .raw and .pcm files)")
+    parser.add_argument("--sample-rate", type=int, default=44100, help="Sample rate of rendered audio")
     parser.add_argument("-v", "--verbose", help="Retrieves text transcription of generated melody", action="store_true")
+    parser.add_argument("--transcript", type=str, default=None, metavar="FILE",
+                        help="Writes the transcription of tones, samples and bars to a file (- writes to stdout)")
+    parser.add_argument("--transcript-format", choices=["text", "json"], default="text",
+                        help="Transcription format (json writes one object per line)")
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="Writes wall/CPU time, allocations and hot-path counters of every stage as JSON")
+    parser.add_argument("--profile", type=str, default=None, help="Writes cProfile stats of the run to a file")
+    parser.add_argument("--cache", type=str, default=None, metavar="DIR",
+                        help="Reuses MIDI files generated before with the same seed and options from a cache directory")
+    parser.add_argument("--cache-size", type=int, default=256,
+                        help="Cache and checkpoint directory size limit in MB (LRU eviction)")
+    parser.add_argument("--checkpoints", type=str, default=None, metavar="DIR",
+                        help="Stores results of every stage in a directory, a re-run with changed options "
+                             "runs only the stages depending on them")
+    parser.add_argument("--cache-stats", help="Prints cache statistics and exits", action="store_true")
+    parser.add_argument("--serve", type=str, default=None, metavar="ADDRESS",
+                        help="Server mode: serves generations over HTTP on HOST:PORT (or a unix socket path)")
+    parser.add_argument("--max-pending", type=int, default=64,
+                        help="Server mode: count of accepted generations before answering 503")
+    parser.add_argument("--batch-seeds", type=str, default=None,
+                        help="Batch mode: file with one seed per line, one melody per seed")
+    parser.add_argument("--batch-count", type=int, default=0,
+                        help="Batch mode: count of melodies generated from random seeds")
+    parser.add_argument("--batch-dir", type=str, default=".",
+                        help="Batch mode: output directory (files are named <seed>.mid)")
+    parser.add_argument("--search", type=str, action="append", default=None, metavar="CRITERION",
+                        help="Search mode: prints seeds meeting every criterion (repeatable), e.g. primary=Am, "
+                             "progression=C,G, tones=4:6, minor=0.5:, samples=8:, pitch_range=:12, density=6:, "
+                             "repetition=0.5:")
+    parser.add_argument("--search-count", type=int, default=0,
+                        help="Search mode: count of random seeds checked (0 searches until interrupted); "
+                             "seeds are read from --batch-seeds when given")
+    parser.add_argument("--search-limit", type=int, default=0, help="Search mode: stops after that many matches")
+    parser.add_argument("--search-dir", type=str, default=None,
+                        help="Search mode: also writes MIDI files of matching seeds to a directory")
+    parser.add_argument("--dataset", type=str, default=None, metavar="DIR",
+                        help="Appends melodies as columnar note records to a sharded dataset directory "
+                             "(in batch mode instead of MIDI files)")
+    parser.add_argument("--shard-rows", type=int, default=1 << 20, help="Count of notes per dataset shard")
+    parser.add_argument("--batch-pitches", action="store_true",
+                        help="Draws dataset pitches again with the vectorized batch pitch engine, a shard at once "
+                             "(requires numpy; pitches do not match MIDI files of the same seeds)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Batch, search and server mode: count of worker processes (default: CPU count)")
     args = parser.parse_args()
+    if args.bars <= 0 and not args.stream:
+        parser.error("endless generation (--bars 0) requires --stream")
+    if args.bars <= 0 and (args.batch_seeds is not None or args.batch_count > 0):
+        parser.error("batch mode requires a positive count of bars")
+    if (args.metrics is not None or args.profile is not None) \
+            and (args.batch_seeds is not None or args.batch_count > 0):
+        parser.error("--metrics and --profile are not supported in batch mode")
+    if (args.metrics is not None or args.profile is not None) and args.cache is not None:
+        parser.error("--metrics and --profile measure generation, they can not be used with --cache")
+    if args.cache_stats and args.cache is None:
+        parser.error("--cache-stats requires --cache")
+    if args.chunk_bars < 0:
+        parser.error("--chunk-bars can not be negative")
+    if args.compounding_friends and (args.chunk_bars > 0 or args.continuous):
+        parser.error("--compounding-friends can not be used with --chunk-bars or --continuous")
+    if args.continuous and (args.chunk_bars > 0 or args.bar_workers > 1):
+        parser.error("--chunk-bars and --bar-workers can not be used with --continuous")
+    if args.bar_workers > 1 and args.chunk_bars == 0:
+        parser.error("--bar-workers requires --chunk-bars")
+    if args.bar_workers > 1 and (args.serve is not None or args.search is not None
+                                 or args.batch_seeds is not None or args.batch_count > 0):
+        parser.error("--bar-workers can not be used in batch and server mode, they already run worker processes")
+    if args.search is not None and (args.serve is not None or args.batch_count > 0 or args.cache is not None
+                                    or args.audio is not None or args.bars <= 0):
+        parser.error("search mode can not be used with --serve, --batch-count, --cache, --audio or endless bars")
+    if args.search is not None:
+        import SeedSearch
+        try:
+            SeedSearch.parse_criteria(args.search)
+        except ValueError as error:
+            parser.error(str(error))
+    if args.checkpoints is not None and (args.cache is not None or args.serve is not None or args.search is not None
+                                         or args.batch_seeds is not None or args.batch_count > 0):
+        parser.error("--checkpoints can not be used with --cache, batch, search and server mode")
+    if args.dataset is not None and (args.cache is not None or args.serve is not None or args.search is not None
+                                     or args.checkpoints is not None or args.bars <= 0):
+        parser.error("--dataset can not be used with --cache, --checkpoints, search and server mode or endless bars")
+    if args.batch_pitches and args.dataset is None:
+        parser.error("--batch-pitches requires --dataset")
+    if args.dataset is not None and args.stream and not args.no_midi:
+        parser.error("--dataset with --stream requires --no-midi (streamed bars feed one output stage)")
+    if args.no_midi and (args.cache is not None or args.serve is not None
+                         or args.batch_seeds is not None or args.batch_count > 0):
+        parser.error("--no-midi can not be used with --cache, batch and server mode")
+    if args.audio is not None and (args.cache is not None or args.serve is not None
+                                   or args.batch_seeds is not None or args.batch_count > 0):
+        parser.error("--audio can not be used with --cache, batch and server mode")
+    if args.audio is not None and args.stream and not args.no_midi:
+        parser.error("--audio with --stream requires --no-midi (streamed bars feed one output stage)")
+    if args.transcript is not None and (args.serve is not None or args.search is not None
+                                        or args.batch_seeds is not None or args.batch_count > 0):
+        parser.error("--transcript can not be used with batch, search and server mode")
+    if args.output == "-" and args.midi_backend != "native":
+        parser.error("writing to stdout requires the native MIDI backend")
+    if args.bars <= 0 and not args.no_midi and (args.output == "-" or (os.path.exists(args.output)
+                                                                     and not os.path.isfile(args.output))):
+        # a MIDI track which can not be seeked back to is written whole at the end
+        parser.error("endless generation can not write MIDI to stdout or pipes, use a file")
+    if args.cache is not None and args.midi_backend != "native":
+        parser.error("--cache requires the native MIDI backend")
     return args
 
 
 def entrypoint():
-    elements_file = "rhythmelements.json"
     args = parse_args()
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
     else:
         logging.basicConfig(level=logging.WARNING)
 
+    options = {
+        'bars': args.bars,
+        'tones': args.tones,
+        'bpm': args.bpm,
+        'continuous': args.continuous,
+        'rich': args.rich,
+        'streaming': args.stream,
+        'midi_backend': args.midi_backend,
+        'chunk_bars': args.chunk_bars,
+        'bar_workers': args.bar_workers
+    }
+    if args.compounding_friends:
+        options['compounding_friends'] = True
+    if args.audio is not None:
+        options['audio_file'] = args.audio
+        options['sample_rate'] = args.sample_rate
+
+    cache = None
+    if args.cache is not None:
+        import OutputCache
+        cache = OutputCache.OutputCache(args.cache, args.cache_size * 1024 * 1024)
+    if args.cache_stats:
+        import json
+        print(json.dumps(cache.stats(), indent=2))
+        return
+
+    if args.serve is not None:
+        import GenerationServer
+        print("Narcotic melody generator by srsly_4 / Szymon Piechaczek, 2017")
+        GenerationServer.run_server(args.serve, args.jobs, args.max_pending, cache)
+        return
+
+    if args.search is not None:
+        import SeedSearch
+        import BatchGenerator
+        seeds = BatchGenerator.read_seeds(args.batch_seeds) if args.batch_seeds is not None \
+            else SeedSearch.random_seeds(args.search_count)
+        SeedSearch.run_search(seeds, args.search, options, args.jobs, args.search_dir, args.search_limit)
+        return
+
+    if args.batch_seeds is not None or args.batch_count > 0:
+        import BatchGenerator
+        print("Narcotic melody generator by srsly_4 / Szymon Piechaczek, 2017")
+        seeds = BatchGenerator.read_seeds(args.batch_seeds) if args.batch_seeds is not None \
+            else BatchGenerator.random_seeds(args.batch_count)
+        if args.dataset is not None:
+            stats = BatchGenerator.export_batch(seeds, args.dataset, options, args.jobs, args.shard_rows,
+                                                 batch_pitches=args.batch_pitches)
+        else:
+            stats = BatchGenerator.generate_batch(seeds, args.batch_dir, options, args.jobs, cache)
+        BatchGenerator.print_stats(stats)
+        return
+
+    if args.bars <= 0:
+        options['bars'] = None
+
+    import Metrics
+    import Pipeline
+
     seed = args.seed
-    print("Seed: " + seed)
-    random.seed(seed)
-
-    results = Processors.ProcessorResults()
-    output_file = args.output
-    processors = [
-        Processors.ElementsParserProcessor(results, elements_file),
-        Processors.ToneGeneratorProcessor(results, args.tones),
-        Processors.SequenceSamplesGeneratorProcessor(results),
-        Processors.BarSampleGeneratorProcessor(results, args.bars)
-        if not args.continuous else Processors.BarGeneratorProcessor(results),
-        Processors.MidiGeneratorProcessor(results, output_file, args.bpm, args.rich)
-    ]
-
-    for processor in processors:
-        processor.process()
+    if seed is None:
+        import SeedRandomizer
+        seed = SeedRandomizer.generate_seed()
+    if args.no_midi:
+        options['midi'] = False
+        output_file = None
+    elif args.output == "-":
+        # keep stdout clean for MIDI data
+        sys.stdout = sys.stderr
+        output_file = sys.__stdout__.buffer
+    else:
+        output_file = args.output
+    import Transcription
+    # the tone sequence is always transcribed, samples and bars when asked for
+    sections = ["tones"]
+    if args.verbose or args.transcript is not None:
+        sections += ["samples", "bars"]
+    elif args.no_midi:
+        sections.append("bars")
+    transcript_stream = sys.stdout
+    if args.transcript is not None and args.transcript != "-":
+        transcript_stream = open(args.transcript, "w", encoding="utf-8")
+    # a transcript requested on stdout (or JSON lines there) gets stdout for itself
+    banner_stream = sys.stderr if transcript_stream is sys.stdout \
+        and (args.transcript is not None or args.transcript_format == "json") else sys.stdout
+    print("Narcotic melody generator by srsly_4 / Szymon Piechaczek, 2017", file=banner_stream)
+    print("Seed: " + seed, file=banner_stream)
+    transcript = Transcription.TranscriptionWriter(transcript_stream, args.transcript_format == "json", sections)
+    metrics = Metrics.PipelineMetrics() if args.metrics is not None else None
+    dataset = None
+    if args.dataset is not None:
+        import DatasetExport
+        dataset = DatasetExport.DatasetWriter(args.dataset, args.shard_rows, args.batch_pitches)
+        options['dataset_sink'] = dataset
+    profiler = None
+    if args.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if cache is not None and options['bars'] is not None:
+            midi_bytes = cache.generate(seed, transcript=transcript, **options)
+            logging.info("Output cache " + ("hit" if cache.hits > 0 else "miss"))
+            if hasattr(output_file, "write"):
+                output_file.write(midi_bytes)
+                output_file.flush()
+            else:
+                with open(output_file, "wb") as midi_f:
+                    midi_f.write(midi_bytes)
+        else:
+            if args.checkpoints is not None:
+                import StageCheckpoints
+                checkpoints = StageCheckpoints.StageCheckpoints(args.checkpoints, args.cache_size * 1024 * 1024)
+                results = checkpoints.run(seed, output_file, metrics, transcript=transcript, **options)
+            else:
+                results = Pipeline.generate(seed, output_file, metrics, transcript=transcript, **options)
+            if args.no_midi:
+                # streamed bars are transcribed as they are generated
+                collections.deque(results.bars, maxlen=0)
+    finally:
+        transcript.close()
+    if dataset is not None:
+        dataset.close()
+        del options['dataset_sink']
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if metrics is not None:
+        metrics.save(args.metrics, seed=seed, options=options)
 
 
 if __name__ == "__main__":